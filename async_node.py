@@ -0,0 +1,206 @@
+import asyncio
+import threading
+import time
+import traceback
+
+from collections import OrderedDict
+from typing import Callable
+from message import Message
+from node import Client, Server, CONN_IDLE_TIMEOUT, ACTIVE_CONNECTIONS, RECEIVED_BYTES, SENT_BYTES
+from connection_pool import POOL_MAX_SIZE, POOL_IDLE_TIMEOUT, POOL_SEND_TIMEOUT
+from framing import FRAME_HEADER, FrameError, pack_frame, read_frame_async
+
+
+class PooledStream:
+    def __init__(self, addr: tuple[str, int]) -> None:
+        self.addr = addr
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+
+    def is_stale(self) -> bool:
+        """
+        Returns True if the stream is closed or the peer has closed it. Peers
+        never write back on a pooled stream, so the reader only ever sees EOF.
+        """
+
+        return self.writer is None or self.writer.is_closing() or self.reader.at_eof()
+
+    async def connect(self) -> None:
+        self.close()
+        self.reader, self.writer = await asyncio.open_connection(*self.addr)
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+class AsyncNode:
+    """
+    Replaces the blocking, thread-per-connection transport of `Node` with a
+    single asyncio event loop. Every incoming and outgoing connection is a
+    stream on that loop, so idle connections cost no threads.
+
+    Must come before `Node` in the bases of a class.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._loop = None
+        self.__loop_thread = None
+        self.__loop_ready = threading.Event()
+        self.__serve_task = None
+        # only used on the loop, so needs no lock of its own
+        self.__streams: OrderedDict[tuple[str, int], PooledStream] = OrderedDict()
+
+    def __checkout(self, addr: tuple[str, int]) -> PooledStream:
+        now = time.monotonic()
+        while self.__streams:
+            oldest = next(iter(self.__streams.values()))
+            if now - oldest.last_used < POOL_IDLE_TIMEOUT:
+                break
+            self.__streams.popitem(last=False)[1].close()
+
+        stream = self.__streams.get(addr)
+        if stream is None:
+            if len(self.__streams) >= POOL_MAX_SIZE:
+                self.__streams.popitem(last=False)[1].close()
+            stream = PooledStream(addr)
+            self.__streams[addr] = stream
+        else:
+            self.__streams.move_to_end(addr)
+        stream.last_used = now
+
+        return stream
+
+    async def _write_to(self, addr: tuple[str, int], data: bytes) -> None:
+        """
+        Writes `data` to `addr`, reusing an open stream to that peer if there
+        is one, it has not sat idle for `POOL_IDLE_TIMEOUT` and the peer has
+        not closed it, and reconnecting once if it turns out to be broken.
+
+        :raises TimeoutError: if connecting and writing take longer than
+        `POOL_SEND_TIMEOUT`
+        """
+
+        try:
+            await asyncio.wait_for(self.__write_to(addr, data), POOL_SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            # the stream may be part way through a frame
+            stream = self.__streams.pop(addr, None)
+            if stream is not None:
+                stream.close()
+            raise TimeoutError(f"Sending to {addr} took over {POOL_SEND_TIMEOUT} seconds.")
+
+    async def __write_to(self, addr: tuple[str, int], data: bytes) -> None:
+        stream = self.__checkout(addr)
+        async with stream.lock:
+            try:
+                if stream.is_stale():
+                    await stream.connect()
+                stream.writer.write(data)
+                await stream.writer.drain()
+
+            except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
+                await stream.connect()
+                stream.writer.write(data)
+                await stream.writer.drain()
+
+            except OSError:
+                stream.close()
+                if self.__streams.get(addr) is stream:
+                    del self.__streams[addr]
+                raise
+
+            # the stream may have been evicted while this write was using it
+            if self.__streams.get(addr) is not stream:
+                stream.close()
+
+    def _send_bytes_to_ip(self, ip_addr: str, data: bytes, recipient_is_client: bool) -> None:
+        port = self._peer_port(recipient_is_client)
+        frame = pack_frame(data)
+        SENT_BYTES.inc(self._node_name, amount=len(frame))
+        coro = self._write_to((ip_addr, port), frame)
+
+        # never block the loop on its own work
+        if threading.current_thread() is self.__loop_thread:
+            self._loop.create_task(coro)
+            return
+
+        self.__loop_ready.wait()
+        asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def __serve_stream(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        handler_method: Callable[[Message], None],
+    ) -> None:
+        ACTIVE_CONNECTIONS.inc(self._node_name)
+        try:
+            while True:
+                data = await asyncio.wait_for(read_frame_async(reader), CONN_IDLE_TIMEOUT)
+                if data is None:
+                    break
+                RECEIVED_BYTES.inc(self._node_name, amount=FRAME_HEADER.size + len(data))
+
+                # handlers may block on the database or on sending a reply, so
+                # they run off the loop; awaiting keeps the connection's order
+                try:
+                    mes = Message.from_bytes(data)
+                    await self._loop.run_in_executor(None, handler_method, mes)
+                except Exception:
+                    traceback.print_exc()
+
+        # cancelled when the loop is stopped; ending normally keeps asyncio
+        # from reporting it as an error
+        except (asyncio.TimeoutError, asyncio.CancelledError, ConnectionResetError, FrameError):
+            pass
+
+        finally:
+            ACTIVE_CONNECTIONS.dec(self._node_name)
+            writer.close()
+
+    async def __serve(self, handler_method: Callable[[Message], None]) -> None:
+        self._loop = asyncio.get_running_loop()
+        self.__serve_task = asyncio.current_task()
+        server = await asyncio.start_server(
+            lambda reader, writer: self.__serve_stream(reader, writer, handler_method),
+            sock=self._recv_socket,
+        )
+        self.__loop_ready.set()
+
+        try:
+            await server.serve_forever()
+        except asyncio.CancelledError: # stopped by `stop`
+            server.close()
+            for stream in self.__streams.values():
+                stream.close()
+
+    def _start_listening(self, handler_method: Callable[[Message], None]) -> None:
+        self.__loop_thread = threading.Thread(
+            target=asyncio.run,
+            args=(self.__serve(handler_method),),
+        )
+        self.__loop_thread.start()
+        self.__loop_ready.wait()
+
+    def stop(self) -> None:
+        """
+        Stops the event loop, closing every connection on it.
+        """
+
+        self.is_running = False
+        if self._loop is not None:
+            # the remaining connection tasks are cancelled when the loop ends
+            self._loop.call_soon_threadsafe(self.__serve_task.cancel)
+            self.__loop_thread.join()
+
+        super().stop()
+
+class AsyncServer(AsyncNode, Server):
+    pass
+
+class AsyncClient(AsyncNode, Client):
+    pass
@@ -1,5 +1,11 @@
+import sys
+
 from ui import UI
+from node import Client
+from async_node import AsyncClient
 
 
-ui = UI()
+# pass --async to use the asyncio transport
+client = AsyncClient() if "--async" in sys.argv[1:] else Client()
+ui = UI(client)
 ui.run_login_page()
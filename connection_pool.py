@@ -0,0 +1,150 @@
+import socket
+import select
+import threading
+import time
+
+from collections import OrderedDict
+
+
+POOL_MAX_SIZE = 32
+POOL_IDLE_TIMEOUT = 30.0
+# seconds a connect or a send may take before the peer is treated as
+# unreachable, so a peer that has gone away cannot hold up the sender
+POOL_SEND_TIMEOUT = 5.0
+
+
+class PooledConnection:
+    def __init__(self, addr: tuple[str, int], timeout: float | None = POOL_SEND_TIMEOUT) -> None:
+        self.addr = addr
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+    def is_stale(self) -> bool:
+        """
+        Returns True if the peer has closed the connection. Peers never write
+        back on a pooled connection, so a readable socket means EOF or reset.
+        """
+
+        if self.sock is None:
+            return True
+
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+
+        return bool(readable)
+
+    def connect(self) -> None:
+        self.close()
+        self.sock = socket.create_connection(self.addr, self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self) -> None:
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+class ConnectionPool:
+    """
+    Keeps outbound TCP connections open between sends, so that consecutive
+    messages to the same peer reuse one socket instead of paying for a new
+    handshake each time.
+    """
+
+    def __init__(
+        self,
+        max_size: int = POOL_MAX_SIZE,
+        idle_timeout: float = POOL_IDLE_TIMEOUT,
+        send_timeout: float | None = POOL_SEND_TIMEOUT,
+    ) -> None:
+        """
+        :param max_size: the maximum number of open connections; the least
+        recently used connection is closed to make room for a new peer
+        :param idle_timeout: seconds after which an unused connection is closed
+        :param send_timeout: seconds a connect or send may take before it
+        fails with `socket.timeout`, or None to wait forever
+        """
+
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.send_timeout = send_timeout
+        self.__conns: OrderedDict[tuple[str, int], PooledConnection] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.__conns)
+
+    def __checkout(self, addr: tuple[str, int]) -> PooledConnection:
+        to_close = []
+        with self.__lock:
+            now = time.monotonic()
+
+            # connections are kept in least recently used order
+            while self.__conns:
+                oldest = next(iter(self.__conns.values()))
+                if now - oldest.last_used < self.idle_timeout:
+                    break
+                to_close.append(self.__conns.popitem(last=False)[1])
+
+            conn = self.__conns.get(addr)
+            if conn is None:
+                if len(self.__conns) >= self.max_size:
+                    to_close.append(self.__conns.popitem(last=False)[1])
+                conn = PooledConnection(addr, self.send_timeout)
+                self.__conns[addr] = conn
+            else:
+                self.__conns.move_to_end(addr)
+            conn.last_used = now
+
+        for old_conn in to_close:
+            with old_conn.lock:
+                old_conn.close()
+
+        return conn
+
+    def send(self, addr: tuple[str, int], data: bytes) -> None:
+        """
+        Sends `data` to `addr` over a pooled connection, reconnecting once if
+        the existing connection turns out to be broken.
+
+        :param addr: the (IP address, port) of the peer
+        :param data: the bytes to send
+        """
+
+        conn = self.__checkout(addr)
+        with conn.lock:
+            try:
+                if conn.is_stale():
+                    conn.connect()
+                conn.sock.sendall(data)
+
+            except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
+                conn.connect()
+                conn.sock.sendall(data)
+
+            except OSError:
+                conn.close()
+                with self.__lock:
+                    if self.__conns.get(addr) is conn:
+                        del self.__conns[addr]
+                raise
+
+            # the connection may have been evicted while this send was using it
+            with self.__lock:
+                if self.__conns.get(addr) is not conn:
+                    conn.close()
+
+    def close_all(self) -> None:
+        with self.__lock:
+            conns = list(self.__conns.values())
+            self.__conns.clear()
+
+        for conn in conns:
+            with conn.lock:
+                conn.close()
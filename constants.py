@@ -5,4 +5,9 @@ USERNAME_MAX_LEN = 20
 MESSAGE_CONTENT_MAX_LEN = 200
 CHAT_NAME_MAX_LEN = 20
 
+# the size in bits of each chat's RSA modulus
+RSA_KEY_BITS = 1024
+# the size in bits of the safe prime used for Diffie-Hellman key exchange
+DH_GROUP_BITS = 512
+
 VALID_NAME_CHARS = string.ascii_letters + string.digits
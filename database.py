@@ -1,27 +1,191 @@
 import sys
 import os
-import shutil
 import json
+import time
+import queue
 import sqlite3
-import encoding
+import functools
+import threading
+import metrics
 
+from enum import Enum
+from typing import Callable
+from concurrent.futures import Future
 from chat_type import ChatType
-from message import Message, MessagePurpose, TextData
-from constants import USERNAME_MAX_LEN, MESSAGE_CONTENT_MAX_LEN
+from message import Message, MessagePurpose, TextData, pack_ints, unpack_ints
+from constants import USERNAME_MAX_LEN, MESSAGE_CONTENT_MAX_LEN, CHAT_NAME_MAX_LEN
+
+
+DB_PATH = "server-db.db"
+
+# applied once to every new connection
+CONN_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA temp_store = MEMORY",
+)
+# applied after CONN_PRAGMAS to the connection that commits saved messages.
+# NORMAL does not sync the WAL to disk on commit, so a batch could be lost
+# after its futures were resolved; FULL syncs once per batch
+WRITER_PRAGMAS = (
+    "PRAGMA synchronous = FULL",
+)
+# the number of prepared statements each connection keeps compiled
+STATEMENT_CACHE_SIZE = 256
+
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 200
+
+# saved messages are committed in batches of at most this many, waiting at
+# most this many seconds after the first for others to join it. With no
+# window, a batch is whatever queued up while the last one was committing,
+# which is best when every caller blocks on its own message
+COMMIT_BATCH_SIZE = 128
+COMMIT_WINDOW = 0.0
+
+# the next sequence number is read from the primary key in the same statement,
+# so no two messages can be given the same one
+INSERT_MESSAGE = """
+    INSERT INTO messages (chat_id, seq, mes_purpose, sender_username, content)
+    SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ? FROM messages
+    WHERE chat_id = ?
+    RETURNING seq
+"""
+
+# the settings every new user starts with
+DEFAULT_SETTINGS = {
+    "color": "white",
+}
+
+DATABASE_SECONDS = metrics.REGISTRY.histogram(
+    "database_seconds",
+    "Time spent in each Database method, including waiting on locks and commits.",
+    ("method",),
+)
+
+
+class NewUserResult(Enum):
+    CREATED         = 0
+    USERNAME_TAKEN  = 1
+    IP_ADDR_TAKEN   = 2
+
+
+def _timed(method: Callable) -> Callable:
+    """
+    Records the time spent in a `Database` method.
+    """
+
+    @functools.wraps(method)
+    def timed_method(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            DATABASE_SECONDS.observe(time.perf_counter() - start, method.__name__)
+
+    return timed_method
 
 
 class Database:
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        db_path: str = DB_PATH,
+        *,
+        commit_batch_size: int = COMMIT_BATCH_SIZE,
+        commit_window: float = COMMIT_WINDOW,
+    ) -> None:
+        """
+        :param commit_batch_size: the most saved messages committed together
+        :param commit_window: the most seconds a saved message waits for
+        others to be committed with it; 0 commits whatever is already waiting
+        """
+
+        self.db_path = db_path
+        self.commit_batch_size = commit_batch_size
+        self.commit_window = commit_window
+        self.__local = threading.local()
+        self.__conns = []
+        self.__conns_lock = threading.Lock()
+        self.__chat_ids = {}
+
+        # chat data by chat name, kept in step with the chats and
+        # chat_members tables by every method that changes them
+        self.__chat_data = {}
+        self.__chat_data_lock = threading.Lock()
+
+        # (version, settings) by username, kept in step with the settings
+        # table; the version goes up by one with every change
+        self.__settings = {}
+        self.__settings_lock = threading.Lock()
+
+        # the user directory, loaded once from the users table and written
+        # through by `create_new_user`; this class owns the database, so the
+        # directory is authoritative and lookups never query it
+        self.__ip_addrs_by_username = {}
+        self.__usernames_by_ip_addr = {}
+        # usernames and IP addresses claimed by users still being inserted
+        self.__reserved_usernames = set()
+        self.__reserved_ip_addrs = set()
+        self.__directory_lock = threading.Lock()
+        self.__directory_hits = 0
+        self.__directory_misses = 0
+
+        # messages waiting to be written, as (row, future) pairs, and the
+        # thread writing them
+        self.__write_queue = queue.SimpleQueue()
+        self.__writer = None
+        self.__writer_lock = threading.Lock()
+
         self.create_new_server_db()
+        self.__load_user_directory()
 
-        if os.path.exists("chats"):
-            shutil.rmtree("chats")
-        os.mkdir("chats")
+    def __get_conn(self) -> sqlite3.Connection:
+        """
+        Returns this thread's connection to the database, opening and
+        configuring it on first use.
+        """
+
+        conn = getattr(self.__local, "conn", None)
+        if conn is None:
+            # only ever used by this thread, but `close` may run on another
+            conn = sqlite3.connect(
+                self.db_path,
+                timeout=10,
+                cached_statements=STATEMENT_CACHE_SIZE,
+                check_same_thread=False,
+            )
+            for pragma in CONN_PRAGMAS:
+                conn.execute(pragma)
+
+            self.__local.conn = conn
+            with self.__conns_lock:
+                self.__conns.append(conn)
 
-        if os.path.exists("settings"):
-            shutil.rmtree("settings")
-        os.mkdir("settings")
+        return conn
+
+    def close(self) -> None:
+        """
+        Commits any messages still waiting to be saved, then closes every
+        thread's connection to the database.
+        """
 
+        with self.__writer_lock:
+            writer = self.__writer
+            self.__writer = None
+        if writer is not None:
+            self.__write_queue.put(None)
+            writer.join()
+
+        with self.__conns_lock:
+            conns = self.__conns
+            self.__conns = []
+
+        for conn in conns:
+            conn.close()
+        self.__local = threading.local()
+
+    @_timed
     def create_new_chat(
         self,
         chat_name: str,
@@ -31,7 +195,7 @@ class Database:
         admins: list[str],
     ) -> None:
         """
-        Creates a new chat history table and saves the chat data in a JSON file.
+        Registers a new chat history and saves the chat data.
 
         :param chat_name: the sanitised chat name
         :param public_key: the public key of the chat
@@ -40,162 +204,334 @@ class Database:
         privileges
         """
 
-        self.create_new_chat_history_table(chat_name)
+        self.create_new_chat_history(chat_name)
         self.save_new_chat_data(chat_name, chat_type, public_key, members, admins)
 
-    def get_all_usernames(self) -> list[str]:
-        conn = sqlite3.connect("server-db.db")
+    def __load_user_directory(self) -> None:
+        """
+        Fills the in-memory user directory from the users table.
+        """
+
+        conn = self.__get_conn()
         c = conn.cursor()
 
-        c.execute("SELECT username FROM users")
-        usernames = c.fetchall()
+        c.execute("SELECT username, ip_addr FROM users")
+        with self.__directory_lock:
+            self.__ip_addrs_by_username = {}
+            self.__usernames_by_ip_addr = {}
+            for username, ip_addr in c.fetchall():
+                self.__ip_addrs_by_username[username] = ip_addr
+                self.__usernames_by_ip_addr[ip_addr] = username
 
-        return [username[0] for username in usernames]
+    @property
+    def directory_stats(self) -> dict[str, int]:
+        """
+        Returns the number of users in the in-memory user directory and how
+        many lookups found and did not find a user.
+        """
 
+        with self.__directory_lock:
+            return {
+                "size": len(self.__ip_addrs_by_username),
+                "hits": self.__directory_hits,
+                "misses": self.__directory_misses,
+            }
+
+    @_timed
+    def get_all_usernames(self) -> list[str]:
+        with self.__directory_lock:
+            return list(self.__ip_addrs_by_username)
+
+    @_timed
     def get_all_ip_addresses(self) -> list[str]:
-        conn = sqlite3.connect("server-db.db")
-        c = conn.cursor()
+        with self.__directory_lock:
+            return list(self.__usernames_by_ip_addr)
+
+    def __get_directory_entry(self, directory: dict[str, str], key: str) -> str | None:
+        with self.__directory_lock:
+            value = directory.get(key)
+            if value is not None:
+                self.__directory_hits += 1
+            else:
+                self.__directory_misses += 1
 
-        c.execute("SELECT ip_addr FROM users")
-        ip_addrs = c.fetchall()
+            return value
 
-        return [ip_addr[0] for ip_addr in ip_addrs]
+    @_timed
+    def username_exists(self, username: str) -> bool:
+        ip_addr = self.__get_directory_entry(self.__ip_addrs_by_username, username)
 
+        return ip_addr is not None
+
+    @_timed
+    def ip_addr_exists(self, ip_addr: str) -> bool:
+        username = self.__get_directory_entry(self.__usernames_by_ip_addr, ip_addr)
+
+        return username is not None
+
+    @_timed
     def get_username_from_ip_addr(self, ip_addr: str) -> str:
-        conn = sqlite3.connect("server-db.db")
+        username = self.__get_directory_entry(self.__usernames_by_ip_addr, ip_addr)
+        if username is None:
+            raise ValueError(f"No user has the IP address \"{ip_addr}\".")
+
+        return username
+
+    @_timed
+    def get_ip_addr_from_username(self, username: str) -> str:
+        ip_addr = self.__get_directory_entry(self.__ip_addrs_by_username, username)
+        if ip_addr is None:
+            raise ValueError(f"No user has the username \"{username}\".")
+
+        return ip_addr
+
+    @_timed
+    def test_username_password_hash_match(self, username: str, password_hash: str) -> bool:
+        conn = self.__get_conn()
         c = conn.cursor()
 
         c.execute(
             """
-            SELECT username FROM users
-            WHERE ip_addr = ?
+            SELECT * FROM users
+            WHERE username = ? AND password_hash = ?
             """,
-            (ip_addr,))
+            (username, password_hash),
+        )
         results = c.fetchall()
-        username = results[0][0]
 
-        return username
+        return len(results) > 0
 
-    def get_ip_addr_from_username(self, username: str) -> str:
-        conn = sqlite3.connect("server-db.db")
+    @_timed
+    def get_user_chat_names(self, username: str) -> list[str]:
+        """
+        Returns the names of every chat a user is a member of, oldest first.
+        """
+
+        conn = self.__get_conn()
         c = conn.cursor()
 
         c.execute(
             """
-            SELECT ip_addr FROM users
+            SELECT chat_name FROM chat_members
+            JOIN chats USING (chat_id)
             WHERE username = ?
+            ORDER BY chat_id
             """,
-            (username,))
-        results = c.fetchall()
-        ip_addr = results[0][0]
+            (username,),
+        )
 
-        return ip_addr
+        return [chat_name[0] for chat_name in c.fetchall()]
 
-    def test_username_password_hash_match(self, username: str, password_hash: str) -> bool:
-        conn = sqlite3.connect("server-db.db")
+    @staticmethod
+    def __copy_chat_data(chat_data: dict[str, any]) -> dict[str, any]:
+        return {
+            "chatType": chat_data["chatType"],
+            "pubKey": list(chat_data["pubKey"]),
+            "members": list(chat_data["members"]),
+            "admins": list(chat_data["admins"]),
+            "nicknames": dict(chat_data["nicknames"]),
+        }
+
+    def __load_chat_data(self, chat_name: str) -> dict[str, any]:
+        conn = self.__get_conn()
         c = conn.cursor()
 
+        chat_id = self.__get_chat_id(chat_name)
         c.execute(
             """
-            SELECT * FROM users
-            WHERE username = ? AND password_hash = ?
+            SELECT chat_type, pub_key_n, pub_key_e FROM chats
+            WHERE chat_id = ?
             """,
-            (username, password_hash),
+            (chat_id,),
+        )
+        chat_type, pub_key_n, pub_key_e = c.fetchone()
+
+        c.execute(
+            """
+            SELECT username, is_admin, nickname FROM chat_members
+            WHERE chat_id = ?
+            """,
+            (chat_id,),
         )
         results = c.fetchall()
 
-        return len(results) > 0
+        return {
+            "chatType": chat_type,
+            "pubKey": [int(pub_key_n), int(pub_key_e)],
+            "members": [username for (username, _, _) in results],
+            "admins": [username for (username, is_admin, _) in results if is_admin],
+            "nicknames": {username: nickname for (username, _, nickname) in results},
+        }
 
-    def get_user_chat_names(self, username: str) -> list[str]:
-        user_chat_names = []
-        for chat in os.listdir("chats"):
-            with open(f"chats/{chat}", "r") as f:
-                f_dict = json.load(f)
+    @_timed
+    def get_chat_data(self, chat_name: str) -> dict[str, any]:
+        """
+        Returns a copy of a chat's type, public key, members, admins and
+        nicknames.
 
-            if username in f_dict["members"]:
-                chat_name = chat.split(".")[0]
-                user_chat_names.append(chat_name)
+        :param chat_name: the sanitised chat name
+        """
 
-        return user_chat_names
+        with self.__chat_data_lock:
+            chat_data = self.__chat_data.get(chat_name)
+            if chat_data is None:
+                chat_data = self.__load_chat_data(chat_name)
+                self.__chat_data[chat_name] = chat_data
 
-    def get_chat_data(self, chat_name: str) -> dict[str, any]:
-        with open(f"chats/{chat_name}.json", "r") as f:
-            data = json.load(f)
-        return data
+            return self.__copy_chat_data(chat_data)
 
+    @_timed
     def get_chat_messages(
         self,
         chat_name: str,
-        num_messages: int,
+        *,
+        before: int | None = None,
+        since: int | None = None,
+        limit: int = DEFAULT_PAGE_SIZE,
     ) -> list[Message]:
-        chat_name = "_" + encoding.hash_str(chat_name)
+        """
+        Returns a page of a chat's messages, oldest first. Only the page
+        itself is read, however long the chat is.
 
-        conn = sqlite3.connect("server-db.db")
-        c = conn.cursor()
+        :param chat_name: the sanitised chat name
+        :param before: only return messages with a sequence number below this;
+        the newest messages are returned if neither this nor `since` is given
+        :param since: only return messages with a sequence number above this,
+        so a client can fetch just the ones it has not seen. The oldest such
+        messages are returned, so a client can page forward until it gets a
+        page that is not full
+        :param limit: the maximum number of messages to return, capped at
+        `MAX_PAGE_SIZE`
+        """
 
-        c.execute(f"SELECT MAX(rowid) FROM {chat_name}")
-        max_id = c.fetchall()[0][0]
-        if max_id is None:
-            return []
+        chat_id = self.__get_chat_id(chat_name)
+        limit = max(0, min(limit, MAX_PAGE_SIZE))
+        # page forward from `since`, or back from `before`
+        order = "ASC" if since is not None else "DESC"
+        if before is None:
+            before = sys.maxsize
+        if since is None:
+            since = 0
 
-        min_id = max(1, max_id - num_messages)
+        conn = self.__get_conn()
+        c = conn.cursor()
 
         c.execute(
             f"""
-            SELECT * FROM {chat_name}
-            WHERE rowid >= ?;
+            SELECT seq, mes_purpose, sender_username, content FROM messages
+            WHERE chat_id = ? AND seq > ? AND seq < ?
+            ORDER BY seq {order}
+            LIMIT ?
             """,
-            (min_id,)
+            (chat_id, since, before, limit),
         )
         results = c.fetchall()
+        if order == "DESC":
+            results.reverse()
+        reads = self.get_chat_reads(chat_name)
 
         messages = []
-        for (mes_purpose, sender_username, content, views) in results:
+        for (seq, mes_purpose, sender_username, content) in results:
+            if isinstance(content, bytes):
+                content = unpack_ints(content)
             messages.append(Message(
                 MessagePurpose(mes_purpose),
                 sender_username,
                 TextData(content),
                 chat_name=chat_name,
-                views=views.split(","),
+                views=[name for name, last_read_seq in reads.items() if last_read_seq >= seq],
                 is_encrypted=True,
+                seq=seq,
             ))
 
         return messages
 
+    @_timed
+    def get_chat_reads(self, chat_name: str) -> dict[str, int]:
+        """
+        Returns the read position of every member who has opened a chat.
+
+        :param chat_name: the sanitised chat name
+        :returns: a dict mapping usernames to the sequence number of the
+        newest message they have seen
+        """
+
+        conn = self.__get_conn()
+        c = conn.cursor()
+
+        c.execute(
+            """
+            SELECT username, last_read_seq FROM chat_reads
+            WHERE chat_id = ?
+            """,
+            (self.__get_chat_id(chat_name),),
+        )
+
+        return dict(c.fetchall())
+
+    @_timed
     def create_new_user(
         self,
         username: str,
         ip_addr: str,
         password_hash: str,
-    ) -> None:
+    ) -> NewUserResult:
         """
-        Saves a new user into the users table.
+        Saves a new user into the users table, unless the username or IP
+        address is already taken.
 
         :param username: the sanitised username
         :param ip_addr: the 8 digit hex representation of the user's IP
         address
         :param password_hash: the 64 digit hex representation of the hash
         of the user's password
+        :returns: whether the user was created, and if not, why
         """
 
-        conn = sqlite3.connect("server-db.db")
+        conn = self.__get_conn()
         c = conn.cursor()
 
-        c.execute(
-            """
-            INSERT INTO users (username, ip_addr, password_hash)
-            VALUES (?, ?, ?)
-            """,
-            (username, ip_addr, password_hash,),
-        )
-        conn.commit()
+        # the username and IP address are reserved while the lock is held, so
+        # two users can never both claim one, but the insert happens outside
+        # it so lookups are never held up by a commit
+        with self.__directory_lock:
+            if username in self.__ip_addrs_by_username or username in self.__reserved_usernames:
+                return NewUserResult.USERNAME_TAKEN
+            if ip_addr in self.__usernames_by_ip_addr or ip_addr in self.__reserved_ip_addrs:
+                return NewUserResult.IP_ADDR_TAKEN
 
-        data = {
-            "color": "white",
-        }
-        with open(f"settings/{username}.json", "w+") as f:
-            f.write(json.dumps(data, indent=4))
+            self.__reserved_usernames.add(username)
+            self.__reserved_ip_addrs.add(ip_addr)
 
+        try:
+            c.execute(
+                """
+                INSERT INTO users (username, ip_addr, password_hash)
+                VALUES (?, ?, ?)
+                """,
+                (username, ip_addr, password_hash,),
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            with self.__directory_lock:
+                self.__reserved_usernames.discard(username)
+                self.__reserved_ip_addrs.discard(ip_addr)
+            raise
+
+        # only added to the directory once committed, so lookups never see a
+        # user who is only half created
+        with self.__directory_lock:
+            self.__reserved_usernames.discard(username)
+            self.__reserved_ip_addrs.discard(ip_addr)
+            self.__ip_addrs_by_username[username] = ip_addr
+            self.__usernames_by_ip_addr[ip_addr] = username
+
+        self.save_user_settings(username, **DEFAULT_SETTINGS)
+
+        return NewUserResult.CREATED
+
+    @_timed
     def save_new_chat_data(
         self,
         chat_name: str,
@@ -205,7 +541,7 @@ class Database:
         admins: list[str],
     ) -> None:
         """
-        Saves the data of a new chat to a JSON file.
+        Saves the data of a new chat.
 
         :param chat_name: the sanitised chat name
         :param chat_type: the chat type (ChatType.INDIVIDUAL or ChatType.GROUP)
@@ -215,192 +551,528 @@ class Database:
         privileges
         """
 
-        data = {
-            "chatType": chat_type.value,
-            "pubKey": list(public_key),
-            "members": members,
-            "admins": admins,
-            "nicknames": {m: m for m in members},
-        }
+        conn = self.__get_conn()
+        c = conn.cursor()
 
-        with open(f"chats/{chat_name}.json", "w+") as f:
-            f.write(json.dumps(data, indent=4))
+        chat_id = self.__get_chat_id(chat_name)
+        n, e = public_key
+        with self.__chat_data_lock:
+            # both tables are written in one transaction
+            with conn:
+                c.execute(
+                    """
+                    UPDATE chats SET chat_type = ?, pub_key_n = ?, pub_key_e = ?
+                    WHERE chat_id = ?
+                    """,
+                    (chat_type.value, str(n), str(e), chat_id),
+                )
+                c.executemany(
+                    """
+                    INSERT INTO chat_members (username, chat_id, is_admin, nickname)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (username, chat_id) DO UPDATE
+                    SET is_admin = excluded.is_admin
+                    """,
+                    [(m, chat_id, m in admins, m) for m in members],
+                )
+
+            self.__chat_data[chat_name] = {
+                "chatType": chat_type.value,
+                "pubKey": list(public_key),
+                "members": list(dict.fromkeys(members)),
+                "admins": [m for m in dict.fromkeys(admins) if m in members],
+                "nicknames": {m: m for m in members},
+            }
 
     def create_new_server_db(self) -> None:
         """
-        Creates the server database and the users table. Should only be called
-        once (each call deletes the existing database if found).
+        Creates the server database and its tables. Should only be called once
+        (each call deletes the existing database if found).
         """
 
-        if os.path.exists("server-db.db"):
-            os.remove("server-db.db")
+        self.close()
+        for path in (self.db_path, self.db_path + "-wal", self.db_path + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
 
-        conn = sqlite3.connect("server-db.db")
+        conn = self.__get_conn()
         c = conn.cursor()
 
         c.execute(f"""
                   CREATE TABLE users(
                   username VARCHAR({USERNAME_MAX_LEN}) PRIMARY KEY,
                   ip_addr VARCHAR(8),
-                  password_hash VARCHAR(64)
+                  password_hash VARCHAR(64),
+                  settings_version INTEGER NOT NULL DEFAULT 0
+                  )
+                  """)
+        # one row per setting, each value stored as JSON
+        c.execute(f"""
+                  CREATE TABLE settings(
+                  username VARCHAR({USERNAME_MAX_LEN}) NOT NULL,
+                  key TEXT NOT NULL,
+                  value TEXT NOT NULL,
+                  PRIMARY KEY (username, key)
+                  ) WITHOUT ROWID
+                  """)
+        c.execute(f"""
+                  CREATE TABLE chats(
+                  chat_id INTEGER PRIMARY KEY,
+                  chat_name VARCHAR({CHAT_NAME_MAX_LEN}) UNIQUE NOT NULL,
+                  chat_type INT NOT NULL DEFAULT {ChatType.INDIVIDUAL.value},
+                  pub_key_n TEXT,
+                  pub_key_e TEXT
                   )
                   """)
+        # the primary key is the table's only index and holds every column,
+        # so a page of a chat's history is a single range scan
+        c.execute(f"""
+                  CREATE TABLE messages(
+                  chat_id INTEGER NOT NULL,
+                  seq INTEGER NOT NULL,
+                  mes_purpose INT,
+                  sender_username VARCHAR({USERNAME_MAX_LEN}),
+                  content VARCHAR({MESSAGE_CONTENT_MAX_LEN}),
+                  PRIMARY KEY (chat_id, seq)
+                  ) WITHOUT ROWID
+                  """)
+        # each member's read position in a chat; a member has seen every
+        # message up to and including last_read_seq
+        c.execute(f"""
+                  CREATE TABLE chat_reads(
+                  chat_id INTEGER NOT NULL,
+                  username VARCHAR({USERNAME_MAX_LEN}) NOT NULL,
+                  last_read_seq INTEGER NOT NULL,
+                  PRIMARY KEY (chat_id, username)
+                  ) WITHOUT ROWID
+                  """)
+        # keyed by username first, so a user's chats are a single range scan;
+        # the index on chat_id does the same for a chat's members
+        c.execute(f"""
+                  CREATE TABLE chat_members(
+                  username VARCHAR({USERNAME_MAX_LEN}) NOT NULL,
+                  chat_id INTEGER NOT NULL,
+                  is_admin INT NOT NULL DEFAULT 0,
+                  nickname VARCHAR({USERNAME_MAX_LEN}) NOT NULL,
+                  PRIMARY KEY (username, chat_id)
+                  ) WITHOUT ROWID
+                  """)
+        c.execute("""
+                  CREATE INDEX chat_members_by_chat ON chat_members (chat_id)
+                  """)
+        self.__chat_ids = {}
+        self.__chat_data = {}
+        self.__settings = {}
+
+    def __get_chat_id(self, chat_name: str) -> int:
+        chat_id = self.__chat_ids.get(chat_name)
+        if chat_id is not None:
+            return chat_id
+
+        conn = self.__get_conn()
+        c = conn.cursor()
+
+        c.execute(
+            """
+            SELECT chat_id FROM chats
+            WHERE chat_name = ?
+            """,
+            (chat_name,),
+        )
+        results = c.fetchall()
+        if not results:
+            raise ValueError(f"No chat named \"{chat_name}\".")
+
+        chat_id = results[0][0]
+        self.__chat_ids[chat_name] = chat_id
 
-    def __get_chat_history_table_name(self, chat_name: str) -> str:
-        return "_" + encoding.hash_str(chat_name)
+        return chat_id
 
-    def create_new_chat_history_table(self, chat_name: str) -> None:
+    @_timed
+    def create_new_chat_history(self, chat_name: str) -> None:
         """
-        Creates a new chat history for a new chat.
+        Registers a new chat so that messages can be saved to it.
 
         :param chat_name: the sanitised chat name
         """
 
-        conn = sqlite3.connect("server-db.db")
+        conn = self.__get_conn()
         c = conn.cursor()
 
-        chat_name = self.__get_chat_history_table_name(chat_name)
         c.execute(
-            f"""
-            CREATE TABLE {chat_name}(
-            mes_purpose INT,
-            sender_username VARCHAR({USERNAME_MAX_LEN}),
-            content VARCHAR({MESSAGE_CONTENT_MAX_LEN}),
-            views VARCHAR(1000)
-            )
+            """
+            INSERT INTO chats (chat_name)
+            VALUES (?)
             """,
+            (chat_name,),
         )
+        conn.commit()
+        self.__chat_ids[chat_name] = c.lastrowid
 
-    def save_message(self, message: Message) -> None:
+    def save_message_async(self, message: Message) -> Future:
         """
-        Saves a message to the relevant chat history table.
+        Queues a message to be appended to its chat's history. Messages are
+        committed in batches, so many can share the cost of one sync to disk.
 
         :param message: the sanitised message
+        :returns: a future that gives the message's sequence number within
+        the chat once the message has been committed and synced to disk
         """
 
-        conn = sqlite3.connect("server-db.db")
-        c = conn.cursor()
-
-        chat_name = self.__get_chat_history_table_name(message.chat_name)
+        chat_id = self.__get_chat_id(message.chat_name)
         mes_purpose = message.mes_purpose.value
         sender_username = self.get_username_from_ip_addr(message.sender)
         content = message.content.value
-        views = ",".join(message.views)
+        if isinstance(content, list): # ciphertext blocks
+            content = pack_ints(content)
+
+        future = Future()
+        with self.__writer_lock:
+            if self.__writer is None:
+                self.__writer = threading.Thread(
+                    target=self.__write_loop,
+                    name="database-writer",
+                    daemon=True,
+                )
+                self.__writer.start()
+
+            self.__write_queue.put(((chat_id, mes_purpose, sender_username, content, chat_id), future))
+
+        return future
+
+    @_timed
+    def save_message(self, message: Message) -> int:
+        """
+        Appends a message to its chat's history, returning once it has been
+        committed.
+
+        :param message: the sanitised message
+        :returns: the message's sequence number within the chat
+        """
 
+        return self.save_message_async(message).result()
+
+    def __next_batch(self) -> tuple[list[tuple[tuple, Future]], bool]:
+        """
+        Waits for messages to save and collects them into a batch.
+
+        :returns: the batch, and whether the writer has been told to stop
+        """
+
+        batch = []
+        item = self.__write_queue.get()
+        deadline = time.monotonic() + self.commit_window
+        while item is not None:
+            batch.append(item)
+            if len(batch) >= self.commit_batch_size:
+                return batch, False
+
+            try:
+                timeout = deadline - time.monotonic()
+                if timeout > 0:
+                    item = self.__write_queue.get(timeout=timeout)
+                else:
+                    item = self.__write_queue.get_nowait()
+            except queue.Empty:
+                return batch, False
+
+        return batch, True
+
+    def __write_batch(self, batch: list[tuple[tuple, Future]]) -> None:
+        """
+        Writes a batch of messages in one transaction and resolves their
+        futures once it commits. If the transaction fails, the messages are
+        written one at a time so only the ones at fault fail.
+        """
+
+        conn = self.__get_conn()
+        c = conn.cursor()
+        start = time.perf_counter()
+
+        try:
+            seqs = []
+            with conn:
+                for row, _ in batch:
+                    c.execute(INSERT_MESSAGE, row)
+                    seqs.append(c.fetchone()[0])
+        except sqlite3.Error:
+            for row, future in batch:
+                try:
+                    with conn:
+                        c.execute(INSERT_MESSAGE, row)
+                        seq = c.fetchone()[0]
+                except sqlite3.Error as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(seq)
+            return
+
+        finally:
+            DATABASE_SECONDS.observe(time.perf_counter() - start, "commit_batch")
+
+        for (_, future), seq in zip(batch, seqs):
+            future.set_result(seq)
+
+    def __write_loop(self) -> None:
+        conn = self.__get_conn()
+        for pragma in WRITER_PRAGMAS:
+            conn.execute(pragma)
+
+        stopping = False
+        while not stopping:
+            batch, stopping = self.__next_batch()
+            if batch:
+                self.__write_batch(batch)
+
+    @_timed
+    def view_messages(self, chat_name: str, username: str) -> None:
+        """
+        Marks every message currently in a chat as seen by a user. This moves
+        the user's read position rather than touching the messages, so it
+        costs the same however long the chat is.
+
+        :param chat_name: the sanitised chat name
+        :param username: the user who has seen the messages
+        """
+
+        conn = self.__get_conn()
+        c = conn.cursor()
+
+        chat_id = self.__get_chat_id(chat_name)
         c.execute(
-            f"""
-            INSERT INTO {chat_name} (mes_purpose, sender_username, content, views)
-            VALUES (?, ?, ?, ?)
+            """
+            INSERT INTO chat_reads (chat_id, username, last_read_seq)
+            SELECT ?, ?, COALESCE(MAX(seq), 0) FROM messages
+            WHERE chat_id = ?
+            ON CONFLICT (chat_id, username) DO UPDATE
+            SET last_read_seq = MAX(last_read_seq, excluded.last_read_seq)
             """,
-            (mes_purpose, sender_username, content, views),
+            (chat_id, username, chat_id),
         )
         conn.commit()
 
-    def view_messages(self, chat_name: str, username: str) -> None:
-        conn = sqlite3.connect("server-db.db")
+    def __load_user_settings(self, username: str) -> tuple[int, dict[str, any]]:
+        conn = self.__get_conn()
         c = conn.cursor()
 
-        chat_name = self.__get_chat_history_table_name(chat_name)
-
-        c.execute(f"SELECT rowid, views FROM {chat_name}")
+        c.execute(
+            """
+            SELECT settings_version FROM users
+            WHERE username = ?
+            """,
+            (username,),
+        )
         results = c.fetchall()
         if not results:
-            return
+            raise ValueError(f"No user with username \"{username}\".")
+        version = results[0][0]
 
-        max_rowid = results[-1][0]
-        min_rowid = None
-        for i in range(len(results)):
-            rowid, views = results[i]
-            views_list = views.split(",")
-            if username not in views_list:
-                min_rowid = rowid
-                break
+        c.execute(
+            """
+            SELECT key, value FROM settings
+            WHERE username = ?
+            """,
+            (username,),
+        )
+        settings = {key: json.loads(value) for (key, value) in c.fetchall()}
 
-        if min_rowid is None:
-            return
+        return version, settings
 
-        for i in range(min_rowid, max_rowid + 1):
-            views_list = results[i-1][1].split(",")
-            views_list = [name for name in views_list if name]
-            views_list.append(username)
-            views = ",".join(views_list)
-            c.execute(
-                f"""
-                UPDATE {chat_name}
-                SET views = ?
-                WHERE rowid = ?
-                """,
-                (views, i),
-            )
-            conn.commit()
+    @_timed
+    def get_user_settings_versioned(self, username: str) -> tuple[int, dict[str, any]]:
+        """
+        Returns a user's settings along with their version, which changes
+        whenever any setting does.
 
-    def get_user_settings(self, username: str) -> dict[str, any]:
-        with open(f"settings/{username}.json", "r") as f:
-            settings = json.load(f)
+        :returns: the version and a copy of the settings
+        """
 
-        return settings
+        with self.__settings_lock:
+            entry = self.__settings.get(username)
+            if entry is None:
+                entry = self.__load_user_settings(username)
+                self.__settings[username] = entry
+
+            version, settings = entry
+            return version, dict(settings)
+
+    def get_user_settings(self, username: str) -> dict[str, any]:
+        return self.get_user_settings_versioned(username)[1]
 
+    @_timed
     def save_user_settings(
         self,
         username: str,
         *,
         color: str = None,
     ) -> None:
-        settings = self.get_user_settings(username)
+        changes = {}
         if color is not None:
-            settings["color"] = color
+            changes["color"] = color
+        if not changes:
+            return
+
+        conn = self.__get_conn()
+        c = conn.cursor()
+
+        with self.__settings_lock:
+            with conn:
+                c.executemany(
+                    """
+                    INSERT INTO settings (username, key, value)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT (username, key) DO UPDATE
+                    SET value = excluded.value
+                    """,
+                    [(username, key, json.dumps(value)) for key, value in changes.items()],
+                )
+                c.execute(
+                    """
+                    UPDATE users SET settings_version = settings_version + 1
+                    WHERE username = ?
+                    RETURNING settings_version
+                    """,
+                    (username,),
+                )
+                results = c.fetchall()
+                if not results:
+                    raise ValueError(f"No user with username \"{username}\".")
+                version = results[0][0]
+
+            # users whose settings are not cached yet are loaded on first use
+            entry = self.__settings.get(username)
+            if entry is not None:
+                self.__settings[username] = (version, entry[1] | changes)
+
+    def __update_chat_member(
+        self,
+        chat_name: str,
+        username: str,
+        statement: str,
+        params: tuple,
+        update_cache: Callable[[dict[str, any]], None],
+    ) -> None:
+        """
+        Runs a statement changing one chat member's row and applies the same
+        change to the cached chat data.
+
+        :param statement: the SQL statement, whose last two parameters are
+        the username and chat ID
+        :param update_cache: applies the change to the cached chat data
+        """
+
+        conn = self.__get_conn()
+        c = conn.cursor()
+
+        chat_id = self.__get_chat_id(chat_name)
+        with self.__chat_data_lock:
+            with conn:
+                c.execute(statement, (*params, username, chat_id))
 
-        with open(f"settings/{username}.json", "w+") as f:
-            f.write(json.dumps(settings, indent=4))
+            chat_data = self.__chat_data.get(chat_name)
+            if chat_data is not None:
+                update_cache(chat_data)
 
+    @_timed
     def set_nickname(
         self,
         chat_name: str,
         username: str,
         nickname: str,
     ) -> None:
-        chat_data = self.get_chat_data(chat_name)
-        chat_data["nicknames"][username] = nickname
+        def update_cache(chat_data: dict[str, any]) -> None:
+            if username in chat_data["nicknames"]:
+                chat_data["nicknames"][username] = nickname
 
-        with open(f"chats/{chat_name}.json", "w") as f:
-            f.write(json.dumps(chat_data, indent=4))
+        self.__update_chat_member(
+            chat_name,
+            username,
+            """
+            UPDATE chat_members SET nickname = ?
+            WHERE username = ? AND chat_id = ?
+            """,
+            (nickname,),
+            update_cache,
+        )
 
+    @_timed
     def set_privilege(
         self,
         chat_name: str,
         username: str,
         level: str,
     ) -> None:
-        chat_data = self.get_chat_data(chat_name)
-        if level == "admin" and username not in chat_data["admins"]:
-            chat_data["admins"].append(username)
-        elif level == "regular" and username in chat_data["admins"]:
-            chat_data["admins"].remove(username)
-
-        with open(f"chats/{chat_name}.json", "w") as f:
-            f.write(json.dumps(chat_data, indent=4))
+        if level not in ("admin", "regular"):
+            return
+        is_admin = level == "admin"
+
+        def update_cache(chat_data: dict[str, any]) -> None:
+            if username not in chat_data["members"]:
+                return
+            if is_admin and username not in chat_data["admins"]:
+                chat_data["admins"].append(username)
+            elif not is_admin and username in chat_data["admins"]:
+                chat_data["admins"].remove(username)
+
+        self.__update_chat_member(
+            chat_name,
+            username,
+            """
+            UPDATE chat_members SET is_admin = ?
+            WHERE username = ? AND chat_id = ?
+            """,
+            (is_admin,),
+            update_cache,
+        )
 
+    @_timed
     def add_user_to_chat(self, chat_name: str, username: str) -> None:
-        chat_data = self.get_chat_data(chat_name)
-        chat_data["members"].append(username)
-        chat_data["nicknames"][username] = username
-
-        with open(f"chats/{chat_name}.json", "w") as f:
-            f.write(json.dumps(chat_data, indent=4))
+        def update_cache(chat_data: dict[str, any]) -> None:
+            if username not in chat_data["members"]:
+                chat_data["members"].append(username)
+                chat_data["nicknames"][username] = username
+
+        self.__update_chat_member(
+            chat_name,
+            username,
+            """
+            INSERT OR IGNORE INTO chat_members (nickname, username, chat_id)
+            VALUES (?, ?, ?)
+            """,
+            (username,),
+            update_cache,
+        )
 
+    @_timed
     def remove_user_from_chat(self, chat_name: str, username: str) -> None:
-        chat_data = self.get_chat_data(chat_name)
-        chat_data["members"].remove(username)
-        if username in chat_data["admins"]:
-            chat_data["admins"].remove(username)
-        del chat_data["nicknames"][username]
-
-        with open(f"chats/{chat_name}.json", "w") as f:
-            f.write(json.dumps(chat_data, indent=4))
+        def update_cache(chat_data: dict[str, any]) -> None:
+            if username in chat_data["members"]:
+                chat_data["members"].remove(username)
+            if username in chat_data["admins"]:
+                chat_data["admins"].remove(username)
+            chat_data["nicknames"].pop(username, None)
+
+        self.__update_chat_member(
+            chat_name,
+            username,
+            """
+            DELETE FROM chat_members
+            WHERE username = ? AND chat_id = ?
+            """,
+            (),
+            update_cache,
+        )
 
     def debug_display_chat_history(self, chat_name: str) -> None:
-        conn = sqlite3.connect("server-db.db")
+        conn = self.__get_conn()
         c = conn.cursor()
 
-        c.execute(f"SELECT * FROM {chat_name}")
+        c.execute(
+            """
+            SELECT * FROM messages
+            WHERE chat_id = ?
+            ORDER BY seq
+            """,
+            (self.__get_chat_id(chat_name),),
+        )
         print(c.fetchall())
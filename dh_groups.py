@@ -0,0 +1,86 @@
+import os
+import json
+import secrets
+import threading
+import math_funcs
+
+from constants import DH_GROUP_BITS
+
+
+GROUP_CACHE_PATH = "dh-groups.json"
+# the number of groups of each size kept in the cache, so that exchanges do
+# not all share one group
+GROUPS_PER_SIZE = 4
+
+_groups: dict[int, list[tuple[int, int]]] | None = None
+_lock = threading.Lock()
+
+
+def gen_group(bits: int) -> tuple[int, int]:
+    """
+    Returns a new Diffie-Hellman group (p, g), where p is a safe prime of
+    `bits` bits and g is a primitive root modulo p.
+    """
+
+    # p - 1 = 2q with q prime, so finding a primitive root only means
+    # testing two powers of each candidate
+    p = math_funcs.gen_safe_prime(bits)
+    g = math_funcs.primitive_root_mod(p)
+
+    return p, g
+
+def _load_groups() -> dict[int, list[tuple[int, int]]]:
+    global _groups
+    if _groups is None:
+        _groups = {}
+        if os.path.exists(GROUP_CACHE_PATH):
+            with open(GROUP_CACHE_PATH, "r") as f:
+                data = json.load(f)
+            for bits, groups in data.items():
+                _groups[int(bits)] = [tuple(group) for group in groups]
+
+    return _groups
+
+def _save_groups(groups: dict[int, list[tuple[int, int]]]) -> None:
+    with open(GROUP_CACHE_PATH, "w+") as f:
+        f.write(json.dumps({str(bits): groups[bits] for bits in groups}, indent=4))
+
+def fill_group_cache(bits: int = DH_GROUP_BITS, count: int = GROUPS_PER_SIZE) -> None:
+    """
+    Generates groups of `bits` bits until the cache holds `count` of them, and
+    saves the cache to disk. Can be run ahead of time so that no exchange has
+    to wait for a group to be generated.
+    """
+
+    with _lock:
+        groups = _load_groups()
+        size_groups = groups.setdefault(bits, [])
+        if len(size_groups) >= count:
+            return
+
+        while len(size_groups) < count:
+            size_groups.append(gen_group(bits))
+        _save_groups(groups)
+
+def get_group(bits: int = DH_GROUP_BITS) -> tuple[int, int]:
+    """
+    Returns a Diffie-Hellman group (p, g) of `bits` bits from the cache. Only
+    the first call for a given size, on a machine with no cache file, has to
+    generate one.
+    """
+
+    with _lock:
+        size_groups = _load_groups().get(bits)
+        if size_groups:
+            return secrets.choice(size_groups)
+
+    fill_group_cache(bits, 1)
+
+    return get_group(bits)
+
+def gen_secret(p: int) -> int:
+    """
+    Returns a random private exponent for the group with modulus `p`.
+    """
+
+    return secrets.randbelow(p - 3) + 2
@@ -0,0 +1,82 @@
+import struct
+import asyncio
+
+from typing import BinaryIO
+
+
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_LEN = 64 * 1024 * 1024
+
+
+class FrameError(Exception):
+    pass
+
+
+def pack_frame(payload: bytes) -> bytes:
+    """
+    Returns `payload` prefixed with its length.
+
+    :param payload: the bytes to frame
+    :returns: a 4 byte big-endian length header followed by `payload`
+    """
+
+    if len(payload) > MAX_FRAME_LEN:
+        raise ValueError(f"Frame of {len(payload)} bytes exceeds the maximum of {MAX_FRAME_LEN} bytes.")
+
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+def unpack_header(header: bytes) -> int:
+    """
+    Returns the payload length given a frame header.
+    """
+
+    (length,) = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_LEN:
+        raise FrameError(f"Frame of {length} bytes exceeds the maximum of {MAX_FRAME_LEN} bytes.")
+
+    return length
+
+def read_frame(f: BinaryIO) -> bytes | None:
+    """
+    Reads one complete frame from a buffered stream.
+
+    :param f: a binary file object, such as one returned by
+    `socket.makefile("rb")`
+    :returns: the frame's payload, or None if the stream ended cleanly
+    before a new frame started
+    """
+
+    header = f.read(FRAME_HEADER.size)
+    if not header:
+        return None
+    if len(header) < FRAME_HEADER.size:
+        raise FrameError("Connection closed in the middle of a frame header.")
+
+    length = unpack_header(header)
+    payload = f.read(length)
+    if len(payload) < length:
+        raise FrameError("Connection closed in the middle of a frame.")
+
+    return payload
+
+async def read_frame_async(reader: asyncio.StreamReader) -> bytes | None:
+    """
+    Reads one complete frame from an asyncio stream.
+
+    :param reader: the stream to read from
+    :returns: the frame's payload, or None if the stream ended cleanly
+    before a new frame started
+    """
+
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise FrameError("Connection closed in the middle of a frame header.")
+
+    length = unpack_header(header)
+    try:
+        return await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise FrameError("Connection closed in the middle of a frame.")
@@ -0,0 +1,58 @@
+from enum import Enum
+from typing import Callable
+from message import Message, MessagePurpose
+
+
+class Lane(Enum):
+    """
+    Where a handler runs. A lane only decides which threads do the work; the
+    server still starts each sender's requests in the order they arrived,
+    whatever their lanes (see `Server._dispatch`).
+    """
+
+    # on the thread that read the message; only for handlers that never touch
+    # the database, such as lookups the server answers from memory, since
+    # that thread has no database connection of its own
+    INLINE = 0
+    # on the worker pool, in order per sender
+    WORKER = 1
+    # on a separate pool, so slow requests never hold up the worker pool,
+    # once the sender's earlier requests have been handled
+    HEAVY  = 2
+
+class HandlerRegistry:
+    """
+    Maps each message purpose to the function that handles it and the lane
+    it runs on.
+    """
+
+    def __init__(self) -> None:
+        self.__handlers: dict[MessagePurpose, tuple[Callable[[Message], None], Lane]] = {}
+
+    def __contains__(self, purpose: MessagePurpose) -> bool:
+        return purpose in self.__handlers
+
+    def register(
+        self,
+        purpose: MessagePurpose | tuple[MessagePurpose, ...],
+        handler: Callable[[Message], None],
+        lane: Lane = Lane.WORKER,
+    ) -> None:
+        """
+        :param purpose: the purpose, or purposes, `handler` handles
+        :param lane: where `handler` runs
+        """
+
+        purposes = purpose if isinstance(purpose, tuple) else (purpose,)
+        for purpose in purposes:
+            if purpose in self.__handlers:
+                raise ValueError(f"A handler for {purpose} is already registered.")
+            self.__handlers[purpose] = (handler, lane)
+
+    def get(self, purpose: MessagePurpose) -> tuple[Callable[[Message], None], Lane] | None:
+        """
+        :returns: the handler and lane of `purpose`, or None if it has no
+        handler
+        """
+
+        return self.__handlers.get(purpose)
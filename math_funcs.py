@@ -1,4 +1,15 @@
 import math
+import secrets
+
+
+# used to rule out most composites before the Miller-Rabin test
+SMALL_PRIMES = (
+    2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67, 71,
+    73, 79, 83, 89, 97, 101, 103, 107, 109, 113, 127, 131, 137, 139, 149, 151,
+    157, 163, 167, 173, 179, 181, 191, 193, 197, 199, 211, 223, 227, 229, 233,
+    239, 241, 251,
+)
+MILLER_RABIN_ROUNDS = 40
 
 
 def lcm(a: int, b: int) -> int:
@@ -7,13 +18,168 @@ def lcm(a: int, b: int) -> int:
 def is_coprime(a: int, b: int) -> bool:
     return math.gcd(a, b) == 1
 
+def egcd(a: int, b: int) -> tuple[int, int, int]:
+    """
+    Returns (g, x, y) such that a*x + b*y = g = gcd(a, b), by the extended
+    Euclidean algorithm.
+    """
+
+    x0, x1, y0, y1 = 1, 0, 0, 1
+    while b:
+        q, a, b = a // b, b, a % b
+        x0, x1 = x1, x0 - q * x1
+        y0, y1 = y1, y0 - q * y1
+
+    return a, x0, y0
+
 def mod_mul_inv(a: int, m: int) -> int:
-    for i in range(1, m):
-        if (a * i) % m == 1:
-            return i
+    """
+    Returns the inverse of `a` modulo `m`.
+    """
+
+    g, x, _ = egcd(a % m, m)
+    if g != 1:
+        raise ValueError(f"{a} has no inverse modulo {m}.")
+
+    return x % m
+
+def is_probable_prime(n: int, rounds: int = MILLER_RABIN_ROUNDS) -> bool:
+    """
+    Returns True if `n` is prime, with an error probability of at most
+    4^-rounds for composite `n`, by the Miller-Rabin test.
+    """
+
+    if n < 2:
+        return False
+    for p in SMALL_PRIMES:
+        if n % p == 0:
+            return n == p
+
+    d = n - 1
+    s = 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+
+    for _ in range(rounds):
+        a = secrets.randbelow(n - 3) + 2
+        x = pow(a, d, n)
+        if x in (1, n - 1):
+            continue
+        for _ in range(s - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+
+    return True
+
+def gen_prime(bits: int) -> int:
+    """
+    Returns a random prime of exactly `bits` bits.
+    """
+
+    if bits < 3:
+        raise ValueError(f"Cannot generate a prime of {bits} bits.")
+
+    while True:
+        # set the top two bits so the product of two such primes has exactly
+        # twice as many bits, and the bottom bit so the candidate is odd
+        n = secrets.randbits(bits) | (0b11 << (bits - 2)) | 1
+        if is_probable_prime(n):
+            return n
+
+def gen_safe_prime(bits: int) -> int:
+    """
+    Returns a random safe prime of exactly `bits` bits, that is a prime p
+    such that (p - 1) / 2 is also prime.
+    """
+
+    if bits < 3:
+        raise ValueError(f"Cannot generate a safe prime of {bits} bits.")
+
+    while True:
+        q = secrets.randbits(bits - 1) | (1 << (bits - 2)) | 1
+        p = 2 * q + 1
+
+        # cheap filters before the full tests
+        if any(q % s == 0 or p % s == 0 for s in SMALL_PRIMES[1:] if s < q):
+            continue
+        if pow(2, p - 1, p) != 1:
+            continue
+
+        if is_probable_prime(q) and is_probable_prime(p):
+            return p
+
+def _pollard_rho(n: int) -> int:
+    """
+    Returns a non-trivial factor of the odd composite `n`, by Brent's variant
+    of Pollard's rho algorithm.
+    """
+
+    while True:
+        y = secrets.randbelow(n - 1) + 1
+        c = secrets.randbelow(n - 1) + 1
+        g = r = q = 1
+        while g == 1:
+            x = y
+            for _ in range(r):
+                y = (y * y + c) % n
+            k = 0
+            while k < r and g == 1:
+                ys = y
+                for _ in range(min(128, r - k)):
+                    y = (y * y + c) % n
+                    q = q * abs(x - y) % n
+                g = math.gcd(q, n)
+                k += 128
+            r *= 2
+
+        if g == n:
+            g = 1
+            while g == 1:
+                ys = (ys * ys + c) % n
+                g = math.gcd(abs(x - ys), n)
+
+        if g != n:
+            return g
+
+def prime_factors(n: int) -> set[int]:
+    """
+    Returns the distinct prime factors of `n`.
+    """
+
+    factors = set()
+    for p in SMALL_PRIMES:
+        if n % p == 0:
+            factors.add(p)
+            while n % p == 0:
+                n //= p
+
+    to_split = [n] if n > 1 else []
+    while to_split:
+        m = to_split.pop()
+        if is_probable_prime(m):
+            factors.add(m)
+        else:
+            d = _pollard_rho(m)
+            to_split += [d, m // d]
+
+    return factors
+
+def primitive_root_mod(p: int) -> int:
+    """
+    Returns the smallest primitive root modulo the prime `p`. A candidate g
+    is a primitive root exactly when g^((p-1)/q) != 1 (mod p) for every prime
+    factor q of p - 1, so only those few powers are checked.
+    """
 
-def primitive_root_mod(n: int) -> int:
-    coprimes = {i for i in range(1, n) if is_coprime(i, n)}
-    roots = [m for m in range(1, n) if coprimes == {pow(m, i, n) for i in range(1, n)}]
+    factors = prime_factors(p - 1)
+    for g in range(2, p):
+        if all(pow(g, (p - 1) // q, p) != 1 for q in factors):
+            return g
 
-    return roots[-1]
+    if p == 2:
+        return 1
+    raise ValueError(f"{p} has no primitive root.")
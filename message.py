@@ -1,5 +1,6 @@
 import json
 import time
+import struct
 import base64
 import constants
 
@@ -36,9 +37,11 @@ class Data:
 
 class TextData(Data):
     def __init__(self, value: str | list[int]):
+        """
+        :param value: the text, or the ciphertext blocks of encrypted text
+        """
+
         self.value = value
-        if isinstance(self.value, list):
-            self.value = "".join(chr(c) for c in self.value)
 
     def __repr__(self) -> str:
         return f"TextData(\"{self.value}\")"
@@ -70,6 +73,126 @@ def Data_from_JSON_str(s: str) -> Data:
 
     raise ValueError(f"Data cannot have type {data_json['type']} from JSON.")
 
+DATA_TYPES = {
+    0: Data,
+    1: TextData,
+    2: CommandData,
+}
+
+
+# The binary wire format. A message starts with a fixed-width header
+#     version (u8), purpose (u8), flags (u8), data type (u8), timestamp (f64),
+#     seq (u64), request ID (u64)
+# followed by the sender, sender username and chat name as length-prefixed
+# UTF-8 strings, the views as a count followed by that many strings, and
+# finally the content. Lengths and counts are unsigned LEB128 varints. JSON
+# messages always start with "{", which is never a valid version.
+WIRE_VERSION = 2
+WIRE_HEADER = struct.Struct(">BBBBdQQ")
+# version 1 had no request ID
+WIRE_HEADER_V1 = struct.Struct(">BBBBdQ")
+
+FLAG_ENCRYPTED  = 1 << 0
+# the content is a sequence of integers (ciphertext), each packed as a varint
+FLAG_INTS       = 1 << 1
+# the content is raw bytes rather than a string
+FLAG_BYTES      = 1 << 2
+
+
+def pack_varint(buf: bytearray, n: int) -> None:
+    """
+    Appends a non-negative int of any size to `buf` as an unsigned LEB128
+    varint.
+    """
+
+    while n > 0x7f:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+def unpack_varint(b: memoryview, pos: int) -> tuple[int, int]:
+    """
+    Reads a varint written by `pack_varint`.
+
+    :returns: the int and the position just after it
+    """
+
+    n = 0
+    shift = 0
+    while True:
+        byte = b[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+def pack_ints(ns: list[int]) -> bytes:
+    buf = bytearray()
+    pack_varint(buf, len(ns))
+    for n in ns:
+        pack_varint(buf, n)
+
+    return bytes(buf)
+
+def unpack_ints(b: bytes) -> list[int]:
+    b = memoryview(b)
+    count, pos = unpack_varint(b, 0)
+    ns = []
+    for _ in range(count):
+        n, pos = unpack_varint(b, pos)
+        ns.append(n)
+
+    return ns
+
+def pack_fields(fields: list[bytes]) -> bytes:
+    """
+    Joins several byte strings into one, each prefixed with its length, so
+    binary and JSON parts of a response can travel together without either
+    being re-encoded.
+    """
+
+    buf = bytearray()
+    pack_varint(buf, len(fields))
+    for field in fields:
+        _pack_bytes(buf, field)
+
+    return bytes(buf)
+
+def unpack_fields(b: bytes) -> list[bytes]:
+    """
+    Splits a byte string joined by `pack_fields`.
+    """
+
+    b = memoryview(b)
+    count, pos = unpack_varint(b, 0)
+    fields = []
+    for _ in range(count):
+        field, pos = _unpack_bytes(b, pos)
+        fields.append(field)
+
+    return fields
+
+def _pack_bytes(buf: bytearray, b: bytes) -> None:
+    pack_varint(buf, len(b))
+    buf += b
+
+def _pack_str(buf: bytearray, s: str) -> None:
+    _pack_bytes(buf, s.encode("utf-8", "surrogatepass"))
+
+def _unpack_bytes(b: memoryview, pos: int) -> tuple[bytes, int]:
+    length, pos = unpack_varint(b, pos)
+    end = pos + length
+    if end > len(b):
+        raise ValueError("Message is truncated.")
+
+    return bytes(b[pos:end]), end
+
+def _unpack_str(b: memoryview, pos: int) -> tuple[str, int]:
+    s, pos = _unpack_bytes(b, pos)
+
+    return s.decode("utf-8", "surrogatepass"), pos
+
 
 class MessagePurpose(Enum):
     MESSAGE                     = 0
@@ -94,6 +217,8 @@ class MessagePurpose(Enum):
     SET_PRIVILEGE               = 19
     ADD_USER_TO_CHAT            = 20
     REMOVE_USER_FROM_CHAT       = 21
+    OPEN_CHAT                   = 22
+    STATS                       = 23
 
 class Message:
     def __init__(
@@ -107,6 +232,8 @@ class Message:
         views: list[str] = [],
         is_encrypted: bool = False,
         timestamp: float = time.time(),
+        seq: int = 0,
+        request_id: int = 0,
     ):
         self.is_encrypted = is_encrypted
         self.sender = sender
@@ -116,11 +243,18 @@ class Message:
         self.mes_purpose = mes_purpose
         self.content = content
         self.timestamp = timestamp
+        self.seq = seq
+        self.request_id = request_id
 
     def __repr__(self) -> str:
         return f"Message({self.is_encrypted}, {self.mes_purpose}, {self.sender}, {self.sender_username}, {self.chat_name}, {self.views}, {self.content}, {self.timestamp})"
 
-    def __as_JSON_str(self) -> str:
+    def as_JSON_str(self) -> str:
+        """
+        Returns the message in the original JSON wire format, for peers that
+        do not understand the binary one.
+        """
+
         self_dict = deepcopy(self.__dict__)
         self_dict["mes_purpose"] = self.mes_purpose.value
         self_dict["content"] = self.content.as_JSON_str()
@@ -130,7 +264,84 @@ class Message:
         return self_dict_json
 
     def __bytes__(self) -> bytes:
-        return self.__as_JSON_str().encode("utf-8")
+        content = self.content
+        value = content.value
+        flags = FLAG_ENCRYPTED if self.is_encrypted else 0
+        if isinstance(value, list):
+            flags |= FLAG_INTS
+        elif isinstance(value, bytes):
+            flags |= FLAG_BYTES
+
+        buf = bytearray(WIRE_HEADER.pack(
+            WIRE_VERSION,
+            self.mes_purpose.value,
+            flags,
+            int(content),
+            self.timestamp,
+            self.seq,
+            self.request_id,
+        ))
+        _pack_str(buf, self.sender)
+        _pack_str(buf, self.sender_username)
+        _pack_str(buf, self.chat_name)
+        pack_varint(buf, len(self.views))
+        for view in self.views:
+            _pack_str(buf, view)
+
+        if flags & FLAG_INTS:
+            buf += pack_ints(value)
+        elif flags & FLAG_BYTES:
+            _pack_bytes(buf, value)
+        else:
+            _pack_str(buf, value)
+
+        return bytes(buf)
+
+    @staticmethod
+    def __from_binary(b: bytes) -> "Message":
+        b = memoryview(b)
+        version = b[0]
+        if version == WIRE_VERSION:
+            header = WIRE_HEADER.unpack_from(b)
+            pos = WIRE_HEADER.size
+        elif version == 1:
+            header = WIRE_HEADER_V1.unpack_from(b) + (0,)
+            pos = WIRE_HEADER_V1.size
+        else:
+            raise ValueError(f"Unsupported message wire version {version}.")
+        _, mes_purpose, flags, data_type, timestamp, seq, request_id = header
+
+        sender, pos = _unpack_str(b, pos)
+        sender_username, pos = _unpack_str(b, pos)
+        chat_name, pos = _unpack_str(b, pos)
+        num_views, pos = unpack_varint(b, pos)
+        views = []
+        for _ in range(num_views):
+            view, pos = _unpack_str(b, pos)
+            views.append(view)
+
+        if flags & FLAG_INTS:
+            value = unpack_ints(b[pos:])
+        elif flags & FLAG_BYTES:
+            value, pos = _unpack_bytes(b, pos)
+        else:
+            value, pos = _unpack_str(b, pos)
+
+        if data_type not in DATA_TYPES:
+            raise ValueError(f"Data cannot have type {data_type}.")
+
+        return Message(
+            MessagePurpose(mes_purpose),
+            sender,
+            DATA_TYPES[data_type](value),
+            sender_username=sender_username,
+            chat_name=chat_name,
+            views=views,
+            is_encrypted=bool(flags & FLAG_ENCRYPTED),
+            timestamp=timestamp,
+            seq=seq,
+            request_id=request_id,
+        )
 
     @staticmethod
     def dict_from_bytes(b: bytes) -> dict:
@@ -150,8 +361,45 @@ class Message:
             views=d["views"],
             is_encrypted=d["is_encrypted"],
             timestamp=d["timestamp"],
+            seq=d.get("seq", 0),
+            request_id=d.get("request_id", 0),
         )
 
     @staticmethod
     def from_bytes(b: bytes) -> "Message":
-        return Message.from_dict(Message.dict_from_bytes(b))
+        """
+        Decodes a message in either the binary or the JSON wire format.
+        """
+
+        if b[:1] == b"{":
+            return Message.from_dict(Message.dict_from_bytes(b))
+
+        return Message.__from_binary(b)
+
+    @staticmethod
+    def list_to_bytes(messages: list["Message"]) -> bytes:
+        """
+        Encodes several messages as one byte string.
+        """
+
+        buf = bytearray()
+        pack_varint(buf, len(messages))
+        for message in messages:
+            _pack_bytes(buf, bytes(message))
+
+        return bytes(buf)
+
+    @staticmethod
+    def list_from_bytes(b: bytes) -> list["Message"]:
+        """
+        Decodes messages encoded by `list_to_bytes`.
+        """
+
+        b = memoryview(b)
+        count, pos = unpack_varint(b, 0)
+        messages = []
+        for _ in range(count):
+            message, pos = _unpack_bytes(b, pos)
+            messages.append(Message.from_bytes(message))
+
+        return messages
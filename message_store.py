@@ -0,0 +1,59 @@
+import threading
+
+from typing import Iterable
+from message import Message
+
+
+class MessageStore:
+    """
+    Holds the decrypted messages of every chat the client has seen, by
+    sequence number, so that only new messages ever have to be fetched and
+    decrypted.
+    """
+
+    def __init__(self) -> None:
+        self.__chats: dict[str, dict[int, Message]] = {}
+        self.__lock = threading.Lock()
+
+    def add(self, chat_name: str, messages: Iterable[Message]) -> None:
+        """
+        Stores decrypted messages from a chat, replacing any with the same
+        sequence number.
+        """
+
+        with self.__lock:
+            chat = self.__chats.setdefault(chat_name, {})
+            for mes in messages:
+                chat[mes.seq] = mes
+
+    def has(self, chat_name: str, seq: int) -> bool:
+        with self.__lock:
+            return seq in self.__chats.get(chat_name, {})
+
+    def last_seq(self, chat_name: str) -> int:
+        """
+        Returns the highest sequence number stored for a chat, or 0 if none
+        are.
+        """
+
+        with self.__lock:
+            return max(self.__chats.get(chat_name, {}), default=0)
+
+    def get_messages(self, chat_name: str, limit: int | None = None) -> list[Message]:
+        """
+        Returns the stored messages of a chat, oldest first.
+
+        :param limit: if given, only the newest `limit` messages are returned
+        """
+
+        with self.__lock:
+            chat = self.__chats.get(chat_name, {})
+            seqs = sorted(chat)
+            if limit is not None:
+                seqs = seqs[-limit:] if limit > 0 else []
+
+            return [chat[seq] for seq in seqs]
+
+    def remove_chat(self, chat_name: str) -> None:
+        with self.__lock:
+            self.__chats.pop(chat_name, None)
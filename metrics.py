@@ -0,0 +1,343 @@
+import bisect
+import threading
+
+from abc import ABC, abstractmethod
+from typing import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# the upper bounds in seconds of the histogram buckets, as in Prometheus each
+# bucket also counts everything in the buckets below it
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+    5.0, 10.0,
+)
+
+# the prefix of every exported metric name
+NAMESPACE = "messenger"
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(label_names: tuple[str, ...], labels: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(label_names, labels)]
+    if extra:
+        pairs.append(extra)
+
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+class Metric(ABC):
+    """
+    A named metric with one value for each combination of label values.
+    """
+
+    type_name = ""
+
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...] = ()) -> None:
+        self.name = f"{NAMESPACE}_{name}"
+        self.help_text = help_text
+        self.label_names = label_names
+        self._lock = threading.Lock()
+
+    def _check_labels(self, labels: tuple[str, ...]) -> tuple[str, ...]:
+        if len(labels) != len(self.label_names):
+            raise ValueError(f"{self.name} takes labels {self.label_names}, not {labels}.")
+        return tuple(str(label) for label in labels)
+
+    @abstractmethod
+    def snapshot(self) -> list[dict[str, any]]:
+        """
+        Returns every series of the metric, in a form that can be dumped as
+        JSON.
+        """
+
+    @abstractmethod
+    def to_prometheus(self) -> list[str]:
+        """
+        Returns the lines of every series of the metric, in the Prometheus
+        text exposition format.
+        """
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help_text, label_names)
+        self.__values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        labels = self._check_labels(labels)
+        with self._lock:
+            self.__values[labels] = self.__values.get(labels, 0) + amount
+
+    def get(self, *labels: str) -> float:
+        with self._lock:
+            return self.__values.get(self._check_labels(labels), 0)
+
+    def snapshot(self) -> list[dict[str, any]]:
+        with self._lock:
+            return [
+                {"labels": dict(zip(self.label_names, labels)), "value": value}
+                for labels, value in sorted(self.__values.items())
+            ]
+
+    def to_prometheus(self) -> list[str]:
+        with self._lock:
+            return [
+                f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+                for labels, value in sorted(self.__values.items())
+            ]
+
+class Gauge(Metric):
+    """
+    A value that can go up and down, or be read from a function whenever the
+    metrics are collected.
+    """
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help_text, label_names)
+        self.__values: dict[tuple[str, ...], float] = {}
+        self.__functions: dict[tuple[str, ...], Callable[[], float]] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        labels = self._check_labels(labels)
+        with self._lock:
+            self.__values[labels] = self.__values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value: float, *labels: str) -> None:
+        labels = self._check_labels(labels)
+        with self._lock:
+            self.__values[labels] = value
+
+    def set_function(self, function: Callable[[], float], *labels: str) -> None:
+        labels = self._check_labels(labels)
+        with self._lock:
+            self.__functions[labels] = function
+
+    def __collect(self) -> list[tuple[tuple[str, ...], float]]:
+        with self._lock:
+            values = dict(self.__values)
+            functions = dict(self.__functions)
+
+        for labels, function in functions.items():
+            values[labels] = function()
+
+        return sorted(values.items())
+
+    def get(self, *labels: str) -> float:
+        return dict(self.__collect()).get(self._check_labels(labels), 0)
+
+    def snapshot(self) -> list[dict[str, any]]:
+        return [
+            {"labels": dict(zip(self.label_names, labels)), "value": value}
+            for labels, value in self.__collect()
+        ]
+
+    def to_prometheus(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+            for labels, value in self.__collect()
+        ]
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        label_names: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # per label values: the count in each bucket (not cumulative, with
+        # one extra for values above the last bound), the count and the sum
+        self.__values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        labels = self._check_labels(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self.__values.get(labels)
+            if entry is None:
+                entry = ([0] * (len(self.buckets) + 1), [0, 0.0])
+                self.__values[labels] = entry
+            bucket_counts, totals = entry
+            bucket_counts[i] += 1
+            totals[0] += 1
+            totals[1] += value
+
+    def __collect(self) -> list[tuple[tuple[str, ...], list[int], int, float]]:
+        """
+        :returns: the label values, cumulative bucket counts, count and sum of
+        each series
+        """
+
+        with self._lock:
+            series = []
+            for labels, (bucket_counts, (count, total)) in sorted(self.__values.items()):
+                cumulative = []
+                running = 0
+                for bucket_count in bucket_counts[:-1]:
+                    running += bucket_count
+                    cumulative.append(running)
+                series.append((labels, cumulative, count, total))
+
+        return series
+
+    def snapshot(self) -> list[dict[str, any]]:
+        return [
+            {
+                "labels": dict(zip(self.label_names, labels)),
+                "count": count,
+                "sum": total,
+                "buckets": {str(bound): n for bound, n in zip(self.buckets, cumulative)},
+            }
+            for labels, cumulative, count, total in self.__collect()
+        ]
+
+    def to_prometheus(self) -> list[str]:
+        lines = []
+        for labels, cumulative, count, total in self.__collect():
+            for bound, n in zip(self.buckets, cumulative):
+                le = _format_labels(self.label_names, labels, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {n}")
+            le = _format_labels(self.label_names, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {count}")
+
+        return lines
+
+class Registry:
+    """
+    Holds every metric, so they can be read together.
+    """
+
+    def __init__(self) -> None:
+        self.__metrics: dict[str, Metric] = {}
+        self.__lock = threading.Lock()
+
+    def __register(self, metric: Metric) -> Metric:
+        with self.__lock:
+            existing = self.__metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.label_names != metric.label_names:
+                    raise ValueError(f"A different metric named {metric.name} already exists.")
+                return existing
+
+            self.__metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help_text: str, label_names: tuple[str, ...] = ()) -> Counter:
+        return self.__register(Counter(name, help_text, label_names))
+
+    def gauge(self, name: str, help_text: str, label_names: tuple[str, ...] = ()) -> Gauge:
+        return self.__register(Gauge(name, help_text, label_names))
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        label_names: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self.__register(Histogram(name, help_text, label_names, buckets))
+
+    def snapshot(self) -> dict[str, dict[str, any]]:
+        """
+        Returns the current value of every metric, in a form that can be
+        dumped as JSON.
+        """
+
+        with self.__lock:
+            metrics = sorted(self.__metrics.items())
+
+        return {
+            name: {
+                "type": metric.type_name,
+                "help": metric.help_text,
+                "values": metric.snapshot(),
+            }
+            for name, metric in metrics
+        }
+
+    def to_prometheus(self) -> str:
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+
+        with self.__lock:
+            metrics = sorted(self.__metrics.items())
+
+        lines = []
+        for name, metric in metrics:
+            lines.append(f"# HELP {name} {metric.help_text}")
+            lines.append(f"# TYPE {name} {metric.type_name}")
+            lines += metric.to_prometheus()
+
+        return "\n".join(lines) + "\n"
+
+# the registry every part of the program records to
+REGISTRY = Registry()
+
+
+class MetricsExporter:
+    """
+    Serves the metrics of a registry over HTTP, in the Prometheus text format,
+    at /metrics.
+    """
+
+    def __init__(self, addr: tuple[str, int], registry: Registry = REGISTRY) -> None:
+        registry_ = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+
+                body = registry_.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        self.__server = ThreadingHTTPServer(addr, Handler)
+        self.__server.daemon_threads = True
+        self.__thread = None
+
+    @property
+    def addr(self) -> tuple[str, int]:
+        return self.__server.server_address[:2]
+
+    def start(self) -> None:
+        self.__thread = threading.Thread(
+            target=self.__server.serve_forever,
+            name="metrics-exporter",
+            daemon=True,
+        )
+        self.__thread.start()
+
+    def stop(self) -> None:
+        if self.__thread is not None:
+            self.__server.shutdown()
+            self.__thread.join()
+            self.__thread = None
+        self.__server.server_close()
@@ -2,23 +2,28 @@ import os
 import sys
 import socket
 import threading
+import traceback
 import time
 import json
-import sympy
-import secrets
+import itertools
 import ip
 import encoding
 import database
 import vernam
 import rsa
+import dh_groups
+import metrics
 
 from typing import Callable
 from datetime import datetime
-from message import Message, MessagePurpose, Data, TextData, CommandData
+from message import Message, MessagePurpose, Data, TextData, CommandData, pack_fields, unpack_fields
 from chat_type import ChatType
 from constants import USERNAME_MAX_LEN
-from math_funcs import primitive_root_mod
-from ui_data import UIData, UIDataTopic
+from ui_data import UIData, UIDataTopic, UIDataQueue, RESPONSE_TIMEOUT
+from connection_pool import ConnectionPool
+from framing import FRAME_HEADER, FrameError, pack_frame, read_frame
+from worker_pool import WorkerPool
+from handler_registry import HandlerRegistry, Lane
 
 
 SERVER_IP_ADDR = "192.168.0.35"
@@ -27,48 +32,203 @@ CLIENT_SEND_PORT = 8004
 SERVER_SEND_PORT = 8005
 CLIENT_RECV_PORT = 8006
 SERVER_RECV_PORT = 8007
-
-KEY_MIN = 500
-KEY_MAX = 1000
+# the server serves its metrics to Prometheus on this port, on localhost only
+METRICS_PORT = 8008
+
+# seconds an incoming connection may sit without traffic before it is closed
+CONN_IDLE_TIMEOUT = 60.0
+
+SERVER_NUM_WORKERS = 8
+SERVER_MAX_QUEUE_DEPTH = 256
+# threads for slow requests, such as reading pages of chat history
+SERVER_NUM_HEAVY_WORKERS = 2
+# threads sending new messages to online chat members, so a member who cannot
+# be reached never holds up a request worker
+SERVER_NUM_PUSH_WORKERS = 4
+# seconds a connection waits for room in a full request queue before the
+# message is dropped
+SERVER_QUEUE_TIMEOUT = 1.0
+# the maximum number of pushed messages waiting to be handled by the client
+CLIENT_MAX_QUEUE_DEPTH = 256
+
+# the reply to a CREATE_USER request for each outcome
+CREATE_USER_RESPONSES = {
+    database.NewUserResult.CREATED: MessagePurpose.CREATE_USER_DONE,
+    database.NewUserResult.USERNAME_TAKEN: MessagePurpose.CREATE_USER_USERNAME_TAKEN,
+    database.NewUserResult.IP_ADDR_TAKEN: MessagePurpose.CREATE_USER_IP_TAKEN,
+}
+
+ACTIVE_CONNECTIONS = metrics.REGISTRY.gauge(
+    "active_connections",
+    "Incoming connections currently open.",
+    ("node",),
+)
+RECEIVED_BYTES = metrics.REGISTRY.counter(
+    "received_bytes_total",
+    "Bytes received, including frame headers.",
+    ("node",),
+)
+SENT_BYTES = metrics.REGISTRY.counter(
+    "sent_bytes_total",
+    "Bytes sent, including frame headers.",
+    ("node",),
+)
+REQUESTS = metrics.REGISTRY.counter(
+    "requests_total",
+    "Requests handled by the server.",
+    ("purpose",),
+)
+REQUEST_ERRORS = metrics.REGISTRY.counter(
+    "request_errors_total",
+    "Requests whose handler raised an exception.",
+    ("purpose",),
+)
+DROPPED_REQUESTS = metrics.REGISTRY.counter(
+    "dropped_requests_total",
+    "Requests dropped because the request queue was full.",
+    ("purpose",),
+)
+REQUEST_SECONDS = metrics.REGISTRY.histogram(
+    "request_seconds",
+    "Time taken to handle each request, from leaving the queue.",
+    ("purpose",),
+)
+QUEUE_DEPTH = metrics.REGISTRY.gauge(
+    "queue_depth",
+    "Requests waiting for a worker thread.",
+    ("lane",),
+)
 
 
 class Node:
-    def __init__(self, is_client: bool) -> None:
-        self.ip_addr = ip.get_host_ip_addr()
+    def __init__(self, is_client: bool, ip_addr: str | None = None) -> None:
+        """
+        :param ip_addr: the address to listen on; the host's address if not
+        given
+        """
+
+        self.ip_addr = ip_addr if ip_addr is not None else ip.get_host_ip_addr()
+        # the label of this node's metrics
+        self._node_name = "client" if is_client else "server"
         self.is_running = False
         self._recvd_messages = []
+        self._conn_pool = ConnectionPool()
 
-        self.__recv_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.__recv_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.__recv_socket.bind((self.ip_addr, CLIENT_RECV_PORT if is_client else SERVER_RECV_PORT))
+        self._recv_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._recv_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._recv_socket.bind((self.ip_addr, CLIENT_RECV_PORT if is_client else SERVER_RECV_PORT))
 
     @property
     def recvd_messages(self) -> list[Message]:
         return self._recvd_messages
 
+    def _peer_port(self, recipient_is_client: bool) -> int:
+        return CLIENT_RECV_PORT if recipient_is_client else SERVER_RECV_PORT
+
     def _send_bytes_to_ip(self, ip_addr: str, data: bytes, recipient_is_client: bool) -> None:
-        send_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        send_socket.connect((ip_addr, CLIENT_RECV_PORT if recipient_is_client else SERVER_RECV_PORT))
-        send_socket.sendall(data)
-        send_socket.close()
+        port = self._peer_port(recipient_is_client)
+        frame = pack_frame(data)
+        self._conn_pool.send((ip_addr, port), frame)
+        SENT_BYTES.inc(self._node_name, amount=len(frame))
+
+    def _serve_connection(
+        self,
+        conn: socket.socket,
+        handler_method: Callable[[Message], None],
+    ) -> None:
+        """
+        Handles every message sent over one incoming connection until the peer
+        closes it or it sits idle for `CONN_IDLE_TIMEOUT` seconds.
+        """
+
+        conn.settimeout(CONN_IDLE_TIMEOUT)
+        ACTIVE_CONNECTIONS.inc(self._node_name)
+        with conn, conn.makefile("rb") as f:
+            try:
+                while (data := read_frame(f)) is not None:
+                    RECEIVED_BYTES.inc(self._node_name, amount=FRAME_HEADER.size + len(data))
+
+                    # a bad message or a failing handler must not lose the
+                    # messages queued behind it on the connection
+                    try:
+                        handler_method(Message.from_bytes(data))
+                    except Exception:
+                        traceback.print_exc()
+            except (socket.timeout, ConnectionResetError, FrameError):
+                pass
+            finally:
+                ACTIVE_CONNECTIONS.dec(self._node_name)
 
     def _listen_loop(self, handler_method: Callable[[Message], None]) -> None:
-        self.__recv_socket.listen()
+        self._recv_socket.listen()
         while self.is_running:
-            conn, addr = self.__recv_socket.accept()
-            with conn:
-                #data = conn.recv(1044)
-                data = conn.recv(100000)
-                if data:
-                    mes = Message.from_bytes(data)
-                    handler_method(mes)
+            try:
+                conn, addr = self._recv_socket.accept()
+            except OSError:
+                if not self.is_running: # closed by `stop`
+                    break
+                raise
+            threading.Thread(
+                target=self._serve_connection,
+                args=(conn, handler_method),
+                daemon=True,
+            ).start()
+
+    def _start_listening(self, handler_method: Callable[[Message], None]) -> None:
+        """
+        Starts accepting connections in the background, passing every message
+        received to `handler_method`.
+        """
+
+        threading.Thread(
+            target=self._listen_loop,
+            args=(handler_method,),
+        ).start()
+
+    def stop(self) -> None:
+        """
+        Stops accepting connections and closes every outgoing one.
+        """
+
+        self.is_running = False
+        try:
+            self._recv_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._recv_socket.close()
+        self._conn_pool.close_all()
 
 class Client(Node):
-    def __init__(self) -> None:
-        super().__init__(True)
+    def __init__(
+        self,
+        ip_addr: str | None = None,
+        server_ip_addr: str | None = None,
+    ) -> None:
+        """
+        :param ip_addr: the address to listen on; the host's address if not
+        given
+        :param server_ip_addr: the address of the server; `SERVER_IP_ADDR` if
+        not given
+        """
+
+        super().__init__(True, ip_addr)
+        self.server_ip_addr = server_ip_addr if server_ip_addr is not None else SERVER_IP_ADDR
         self.__time_last_checked_new_messages = 0
         self.__diffie_hellman_keys = {}
-        self.ui_data = []
+        self.ui_data = UIDataQueue()
+        self.__request_ids = itertools.count(1)
+        self.__pending_requests = set()
+        self.__pending_requests_lock = threading.Lock()
+        # called with each new message the server pushes from any of the
+        # user's chats, still encrypted
+        self.on_chat_message: Callable[[Message], None] | None = None
+        # called with a chat's name when its private key is saved or deleted,
+        # so anything read or decrypted with the old key can be dropped
+        self.on_chat_key_changed: Callable[[str], None] | None = None
+        # a single worker, so pushed messages are handled in order
+        self._workers = WorkerPool(1, CLIENT_MAX_QUEUE_DEPTH, "client-worker")
+        self.__handlers = HandlerRegistry()
+        self.__register_handlers()
 
     def send_message(self, mes: Message, pub_key: tuple[int, int] | None = None) -> None:
         """
@@ -81,27 +241,94 @@ class Client(Node):
 
         if mes.chat_name:
             mes = rsa.encrypt(mes, pub_key)
-        self._send_bytes_to_ip(SERVER_IP_ADDR, bytes(mes), False)
+        self._send_bytes_to_ip(self.server_ip_addr, bytes(mes), False)
+
+    def send_request(self, mes: Message, pub_key: tuple[int, int] | None = None) -> int:
+        """
+        Sends `mes` to the server with a new request ID. The response can be
+        collected with `wait_for_response`, so several requests can be
+        outstanding at once, even several of the same kind.
+
+        :returns: the request ID
+        """
+
+        mes.request_id = next(self.__request_ids)
+        with self.__pending_requests_lock:
+            self.__pending_requests.add(mes.request_id)
+
+        try:
+            self.send_message(mes, pub_key)
+        except OSError:
+            with self.__pending_requests_lock:
+                self.__pending_requests.discard(mes.request_id)
+            raise
+
+        return mes.request_id
+
+    def wait_for_response(self, request_id: int, timeout: float | None = RESPONSE_TIMEOUT) -> UIData:
+        """
+        Returns the response to the request with the given ID, waiting for it
+        if it has not arrived yet.
+
+        :raises TimeoutError: if the response did not arrive in time
+        """
+
+        try:
+            return self.ui_data.get(request_id, timeout)
+        finally:
+            with self.__pending_requests_lock:
+                self.__pending_requests.discard(request_id)
+
+    def request(
+        self,
+        mes: Message,
+        pub_key: tuple[int, int] | None = None,
+        timeout: float | None = RESPONSE_TIMEOUT,
+    ) -> UIData:
+        """
+        Sends `mes` to the server and returns the response.
+        """
+
+        return self.wait_for_response(self.send_request(mes, pub_key), timeout)
+
+    def __post_ui_data(self, mes: Message, data: UIData) -> None:
+        """
+        Passes `data`, made from the message `mes`, on to the UI. Responses to
+        requests nobody is waiting on any more are dropped.
+        """
+
+        if mes.request_id:
+            with self.__pending_requests_lock:
+                if mes.request_id not in self.__pending_requests:
+                    return
+            data.request_id = mes.request_id
+
+        self.ui_data.put(data)
 
     def send_message_to_ip(self, mes: Message, ip_addr: str) -> None:
         self._send_bytes_to_ip(ip_addr, bytes(mes), True)
 
-    def start_key_exchange(self, ip_addr: str) -> None: # alice
+    def start_key_exchange(self, ip_addr: str) -> int: # alice
         """
-        Initiates the Diffie-Hellman key exchange.
+        Initiates the Diffie-Hellman key exchange. The peer echoes the
+        exchange's ID, so a late reply to an earlier exchange is never taken
+        for this one.
+
+        :returns: the exchange ID, to collect the shared key with
+        `wait_for_response`
         """
 
-        self.__diffie_hellman_keys[ip_addr] = {}
-        p = secrets.choice(list(sympy.primerange(KEY_MIN, KEY_MAX)))
-        g = primitive_root_mod(p)
-        a = secrets.choice(range(1000))
+        p, g = dh_groups.get_group()
+        a = dh_groups.gen_secret(p)
         A = pow(g, a, p)
 
+        exchange_id = next(self.__request_ids)
         self.__diffie_hellman_keys[ip_addr] = {
             "p": p,
             "g": g,
             "a": a,
             "A": A,
+            "exchangeId": exchange_id,
         }
         keys = json.dumps({
             "step": 1,
@@ -110,11 +337,22 @@ class Client(Node):
             "A": A,
         })
 
-        self.send_message_to_ip(Message(
-            MessagePurpose.EXCHANGE,
-            encoding.encode_ip_addr(self.ip_addr),
-            CommandData(keys),
-        ), encoding.decode_ip_addr(ip_addr))
+        with self.__pending_requests_lock:
+            self.__pending_requests.add(exchange_id)
+
+        try:
+            self.send_message_to_ip(Message(
+                MessagePurpose.EXCHANGE,
+                encoding.encode_ip_addr(self.ip_addr),
+                CommandData(keys),
+                request_id=exchange_id,
+            ), encoding.decode_ip_addr(ip_addr))
+        except OSError:
+            with self.__pending_requests_lock:
+                self.__pending_requests.discard(exchange_id)
+            raise
+
+        return exchange_id
 
     def __handle_key_exchange(self, mes: Message) -> None:
         """
@@ -130,7 +368,7 @@ class Client(Node):
             self.__diffie_hellman_keys[ip_addr]["g"] = keys["g"]
             self.__diffie_hellman_keys[ip_addr]["A"] = keys["A"]
 
-            self.__diffie_hellman_keys[ip_addr]["b"] = secrets.choice(range(KEY_MIN, KEY_MAX))
+            self.__diffie_hellman_keys[ip_addr]["b"] = dh_groups.gen_secret(keys["p"])
             self.__diffie_hellman_keys[ip_addr]["B"] = pow(
                 self.__diffie_hellman_keys[ip_addr]["g"],
                 self.__diffie_hellman_keys[ip_addr]["b"],
@@ -150,9 +388,17 @@ class Client(Node):
                     "step": 2,
                     "B": self.__diffie_hellman_keys[ip_addr]["B"],
                 })),
+                request_id=mes.request_id,
             ), encoding.decode_ip_addr(ip_addr))
 
         elif keys["step"] == 2: # alice
+            # only the reply to this peer's latest exchange is used; anything
+            # else answers an exchange that was given up on
+            exchange = self.__diffie_hellman_keys.get(ip_addr)
+            if exchange is None or not mes.request_id \
+            or exchange.get("exchangeId") != mes.request_id:
+                return
+
             self.__diffie_hellman_keys[ip_addr]["B"] = keys["B"]
             self.__diffie_hellman_keys[ip_addr]["s"] = pow(
                 self.__diffie_hellman_keys[ip_addr]["B"],
@@ -161,97 +407,185 @@ class Client(Node):
             )
             print(f"[diffie] alice: {self.__diffie_hellman_keys[ip_addr]=}")
 
-            self.ui_data.append(UIData(
+            self.__post_ui_data(mes, UIData(
                 UIDataTopic.VERNAM_KEY,
                 True,
                 self.__diffie_hellman_keys[ip_addr]["s"],
             ))
 
-    def __handle_message(self, mes: Message) -> None:
-        if mes.mes_purpose == MessagePurpose.EXCHANGE:
-            self.__handle_key_exchange(mes)
-
-        elif mes.mes_purpose == MessagePurpose.KEY:
-            encrypted_data = mes.content.value
-            sender_ip = mes.sender
-            decrypted_data = json.loads(vernam.crypt(
-                encrypted_data,
-                self.__diffie_hellman_keys[sender_ip]["s"],
-            ))
-
-            # save private key locally
-            if not os.path.exists("user-chats"):
-                os.mkdir("user-chats")
-
-            with open(f"user-chats/{decrypted_data['chatName']}.json", "w+") as f:
-                data = json.dump({
-                    "privKey": decrypted_data["privKey"],
-                }, f, indent=4)
-
-        elif mes.mes_purpose == MessagePurpose.CREATE_USER_DONE:
-            self.ui_data.append(UIData(UIDataTopic.CREATE_USER, True))
-
-        elif mes.mes_purpose in {
+    def __register_handlers(self) -> None:
+        # pushed chat messages are decrypted by the UI, so they run on the
+        # worker to keep them from holding up responses on the same
+        # connection; removals follow them so no push outlives its chat
+        self.__handlers.register(MessagePurpose.EXCHANGE, self.__handle_key_exchange, Lane.INLINE)
+        self.__handlers.register(MessagePurpose.KEY, self.__handle_key, Lane.INLINE)
+        self.__handlers.register(MessagePurpose.MESSAGE, self.__handle_chat_message, Lane.WORKER)
+        self.__handlers.register(MessagePurpose.CREATE_USER_DONE, self.__handle_create_user_done, Lane.INLINE)
+        self.__handlers.register((
             MessagePurpose.CREATE_USER_USERNAME_TAKEN,
             MessagePurpose.CREATE_USER_IP_TAKEN,
-        }:
-            self.ui_data.append(UIData(UIDataTopic.CREATE_USER, False))
-
-        elif mes.mes_purpose == MessagePurpose.TEST_LOGIN_SUCCESS:
-            self.ui_data.append(UIData(UIDataTopic.LOG_IN, True))
-
-        elif mes.mes_purpose == MessagePurpose.TEST_LOGIN_FAILURE:
-            self.ui_data.append(UIData(UIDataTopic.LOG_IN, False))
-
-        elif mes.mes_purpose == MessagePurpose.GET_USER_CHAT_NAMES:
-            user_chat_names = json.loads(mes.content.value)
-            self.ui_data.append(UIData(UIDataTopic.GET_USER_CHAT_NAMES, True, user_chat_names))
-
-        elif mes.mes_purpose == MessagePurpose.GET_SETTINGS:
-            self.ui_data.append(UIData(UIDataTopic.SETTINGS, True, mes.content.value))
+        ), self.__handle_create_user_failure, Lane.INLINE)
+        self.__handlers.register(MessagePurpose.TEST_LOGIN_SUCCESS, self.__handle_login_success, Lane.INLINE)
+        self.__handlers.register(MessagePurpose.TEST_LOGIN_FAILURE, self.__handle_login_failure, Lane.INLINE)
+        self.__handlers.register(MessagePurpose.GET_USER_CHAT_NAMES, self.__handle_get_user_chat_names, Lane.INLINE)
+        self.__handlers.register(MessagePurpose.GET_SETTINGS, self.__handle_get_settings, Lane.INLINE)
+        self.__handlers.register(MessagePurpose.GET_ALL_USERNAMES, self.__handle_get_all_usernames, Lane.INLINE)
+        self.__handlers.register(MessagePurpose.GET_IP_ADDR, self.__handle_get_ip_addr, Lane.INLINE)
+        self.__handlers.register(MessagePurpose.GET_CHAT_DATA, self.__handle_get_chat_data, Lane.INLINE)
+        self.__handlers.register(MessagePurpose.GET_CHAT_MESSAGES, self.__handle_get_chat_messages, Lane.INLINE)
+        self.__handlers.register(MessagePurpose.OPEN_CHAT, self.__handle_open_chat, Lane.INLINE)
+        self.__handlers.register(MessagePurpose.STATS, self.__handle_stats, Lane.INLINE)
+        self.__handlers.register(MessagePurpose.REMOVE_USER_FROM_CHAT, self.__handle_remove_user_from_chat, Lane.WORKER)
+
+    def __handle_key(self, mes: Message) -> None:
+        encrypted_data = mes.content.value
+        sender_ip = mes.sender
+        vernam_key = self.__diffie_hellman_keys[sender_ip]["s"]
+        if isinstance(encrypted_data, bytes):
+            decrypted_data = json.loads(vernam.crypt_bytes(encrypted_data, vernam_key))
+        else: # sent as a string by an older client
+            decrypted_data = json.loads(vernam.crypt(encrypted_data, vernam_key))
+
+        # save private key locally
+        if not os.path.exists("user-chats"):
+            os.mkdir("user-chats")
+
+        with open(f"user-chats/{decrypted_data['chatName']}.json", "w+") as f:
+            data = json.dump({
+                "privKey": decrypted_data["privKey"],
+            }, f, indent=4)
+
+        if self.on_chat_key_changed is not None:
+            self.on_chat_key_changed(decrypted_data["chatName"])
+
+    def __handle_chat_message(self, mes: Message) -> None:
+        if self.on_chat_message is not None:
+            self.on_chat_message(mes)
+
+    def __handle_create_user_done(self, mes: Message) -> None:
+        self.__post_ui_data(mes, UIData(UIDataTopic.CREATE_USER, True))
+
+    def __handle_create_user_failure(self, mes: Message) -> None:
+        self.__post_ui_data(mes, UIData(UIDataTopic.CREATE_USER, False))
+
+    def __handle_login_success(self, mes: Message) -> None:
+        self.__post_ui_data(mes, UIData(UIDataTopic.LOG_IN, True))
+
+    def __handle_login_failure(self, mes: Message) -> None:
+        self.__post_ui_data(mes, UIData(UIDataTopic.LOG_IN, False))
+
+    def __handle_get_user_chat_names(self, mes: Message) -> None:
+        user_chat_names = json.loads(mes.content.value)
+        self.__post_ui_data(mes, UIData(UIDataTopic.GET_USER_CHAT_NAMES, True, user_chat_names))
+
+    def __handle_get_settings(self, mes: Message) -> None:
+        self.__post_ui_data(mes, UIData(UIDataTopic.SETTINGS, True, mes.content.value))
+
+    def __handle_get_all_usernames(self, mes: Message) -> None:
+        usernames = json.loads(mes.content.value)
+        self.__post_ui_data(mes, UIData(UIDataTopic.GET_ALL_USERNAMES, True, usernames))
+
+    def __handle_get_ip_addr(self, mes: Message) -> None:
+        ip_addr = mes.content.value
+        self.__post_ui_data(mes, UIData(UIDataTopic.GET_IP_ADDR, True, ip_addr))
+
+    def __handle_get_chat_data(self, mes: Message) -> None:
+        chat_data = json.loads(mes.content.value)
+        self.__post_ui_data(mes, UIData(UIDataTopic.GET_CHAT_DATA, True, chat_data))
+
+    def __handle_get_chat_messages(self, mes: Message) -> None:
+        if isinstance(mes.content.value, bytes):
+            messages = Message.list_from_bytes(mes.content.value)
+        else: # a JSON list of JSON messages, from an older server
+            messages = json.loads(mes.content.value)
+            messages = [Message.from_bytes(message.encode("utf-8")) for message in messages]
+        self.__post_ui_data(mes, UIData(UIDataTopic.GET_CHAT_MESSAGES, True, messages))
 
-        elif mes.mes_purpose == MessagePurpose.GET_ALL_USERNAMES:
-            usernames = json.loads(mes.content.value)
-            self.ui_data.append(UIData(UIDataTopic.GET_ALL_USERNAMES, True, usernames))
+    def __handle_open_chat(self, mes: Message) -> None:
+        metadata, messages = unpack_fields(mes.content.value)
+        data = json.loads(metadata)
+        data["messages"] = Message.list_from_bytes(messages)
+        self.__post_ui_data(mes, UIData(UIDataTopic.OPEN_CHAT, True, data))
 
-        elif mes.mes_purpose == MessagePurpose.GET_IP_ADDR:
-            ip_addr = mes.content.value
-            self.ui_data.append(UIData(UIDataTopic.GET_IP_ADDR, True, ip_addr))
+    def __handle_stats(self, mes: Message) -> None:
+        stats = json.loads(mes.content.value)
+        self.__post_ui_data(mes, UIData(UIDataTopic.STATS, True, stats))
 
-        elif mes.mes_purpose == MessagePurpose.GET_CHAT_DATA:
-            chat_data = json.loads(mes.content.value)
-            self.ui_data.append(UIData(UIDataTopic.GET_CHAT_DATA, True, chat_data))
+    def __handle_remove_user_from_chat(self, mes: Message) -> None:
+        chat_name = mes.content.value
+        os.remove(f"user-chats/{chat_name}.json")
 
-        elif mes.mes_purpose == MessagePurpose.GET_CHAT_MESSAGES:
-            messages = json.loads(mes.content.value)
-            messages = [Message.from_bytes(message) for message in messages]
-            self.ui_data.append(UIData(UIDataTopic.GET_CHAT_MESSAGES, True, messages))
+        if self.on_chat_key_changed is not None:
+            self.on_chat_key_changed(chat_name)
 
-        elif mes.mes_purpose == MessagePurpose.REMOVE_USER_FROM_CHAT:
-            chat_name = mes.content.value
-            os.remove(f"user-chats/{chat_name}.json")
+    def __handle_message(self, mes: Message) -> None:
+        entry = self.__handlers.get(mes.mes_purpose)
+        if entry is None:
+            raise ValueError(f"Invalid MessagePurpose \"{mes.mes_purpose=}\".")
 
+        handler, lane = entry
+        if lane == Lane.INLINE:
+            handler(mes)
         else:
-            raise ValueError(f"Invalid MessagePurpose \"{mes.mes_purpose=}\".")
+            self._workers.submit(mes.sender, handler, mes)
 
     def run(self) -> None:
         self.is_running = True
-        threading.Thread(
-            target=self._listen_loop,
-            args=(self.__handle_message,),
-        ).start()
+        self._workers.start()
+        self._start_listening(self.__handle_message)
+
+    def stop(self) -> None:
+        super().stop()
+        self._workers.stop()
 
     def exit(self) -> None:
         self.is_running = False
+        self._conn_pool.close_all()
         print("exiting")
         sys.exit(0)
 
 class Server(Node):
-    def __init__(self) -> None:
-        super().__init__(False)
+    def __init__(
+        self,
+        num_workers: int = SERVER_NUM_WORKERS,
+        max_queue_depth: int = SERVER_MAX_QUEUE_DEPTH,
+        ip_addr: str | None = None,
+        metrics_port: int | None = METRICS_PORT,
+        num_heavy_workers: int = SERVER_NUM_HEAVY_WORKERS,
+        num_push_workers: int = SERVER_NUM_PUSH_WORKERS,
+    ) -> None:
+        """
+        :param num_workers: the number of threads handling requests
+        :param max_queue_depth: the maximum number of requests waiting on
+        each worker thread
+        :param ip_addr: the address to listen on; the host's address if not
+        given
+        :param metrics_port: the local port to serve metrics to Prometheus
+        on, or None not to
+        :param num_heavy_workers: the number of threads handling slow
+        requests
+        :param num_push_workers: the number of threads pushing new messages
+        to chat members
+        """
 
-        if not os.path.exists("settings"):
-            os.mkdir("settings")
+        super().__init__(False, ip_addr)
+        self._workers = WorkerPool(num_workers, max_queue_depth, "server-worker")
+        self._heavy_workers = WorkerPool(num_heavy_workers, max_queue_depth, "server-heavy-worker")
+        self._push_workers = WorkerPool(num_push_workers, max_queue_depth, "server-pusher")
+        QUEUE_DEPTH.set_function(lambda: self._workers.queue_depth, Lane.WORKER.name)
+        QUEUE_DEPTH.set_function(lambda: self._heavy_workers.queue_depth, Lane.HEAVY.name)
+        QUEUE_DEPTH.set_function(lambda: self._push_workers.queue_depth, "PUSH")
+        self.__handlers = HandlerRegistry()
+        self.__register_handlers()
+        self.__metrics_port = metrics_port
+        self.__metrics_exporter = None
+        # the encoded IP addresses of clients that new messages are pushed to
+        self.__online_ip_addrs = set()
+        self.__online_lock = threading.Lock()
+        # the number of each sender's requests still waiting on the worker
+        # pool, which their later requests must not overtake
+        self.__in_flight = {}
+        self.__in_flight_lock = threading.Lock()
 
         self.__db = database.Database()
         self.__db.create_new_user(
@@ -268,195 +602,454 @@ class Server(Node):
     def __send_message(self, mes: Message, recipient_ip: str) -> None:
         self._send_bytes_to_ip(recipient_ip, bytes(mes), True)
 
-    def __handle_message(self, mes: Message) -> None:
-        # save message
-        if mes.mes_purpose == MessagePurpose.MESSAGE:
-            print(f"Received message: {mes.content.value=}, {mes.is_encrypted=}")
-            self.__db.save_message(mes)
-
-        # create an account
-        elif mes.mes_purpose == MessagePurpose.CREATE_USER:
-            ip_addr = mes.sender
-            username = mes.content.value[:USERNAME_MAX_LEN].split("\0")[0]
-            password_hash = mes.content.value[database.USERNAME_MAX_LEN:database.USERNAME_MAX_LEN + 64]
-
-            if username not in self.__db.get_all_usernames():
-                if ip_addr not in self.__db.get_all_ip_addresses():
-                    self.__db.create_new_user(username, ip_addr, password_hash)
-                    self.__send_message(Message(
-                        MessagePurpose.CREATE_USER_DONE,
-                        self.ip_addr,
-                        Data(),
-                    ), encoding.decode_ip_addr(ip_addr))
-                else:
-                    self.__send_message(Message(
-                        MessagePurpose.CREATE_USER_IP_TAKEN,
-                        self.ip_addr,
-                        Data(),
-                    ), encoding.decode_ip_addr(ip_addr))
-            else:
-                self.__send_message(Message(
-                    MessagePurpose.CREATE_USER_USERNAME_TAKEN,
-                    self.ip_addr,
-                    Data(),
-                ), encoding.decode_ip_addr(ip_addr))
-
-        # create a chat
-        elif mes.mes_purpose == MessagePurpose.CREATE_CHAT:
-            ip_addr = mes.sender
-            data = json.loads(mes.content.value)
-            data["chat_type"] = ChatType(data["chat_type"])
-            self.__db.create_new_chat(*data.values())
-
-        # check if the user successfully logged in
-        elif mes.mes_purpose == MessagePurpose.TEST_LOGIN:
-            ip_addr = mes.sender
-            username = mes.content.value[:USERNAME_MAX_LEN].split("\0")[0]
-            password_hash = mes.content.value[database.USERNAME_MAX_LEN:database.USERNAME_MAX_LEN + 64]
-
-            success = self.__db.test_username_password_hash_match(username, password_hash)
-            self.__send_message(Message(
-                MessagePurpose.TEST_LOGIN_SUCCESS if success else MessagePurpose.TEST_LOGIN_FAILURE,
-                self.ip_addr,
-                Data(),
-            ), encoding.decode_ip_addr(ip_addr))
+    def __reply(self, request: Message, response: Message) -> None:
+        """
+        Sends `response` back to the sender of `request`, tagged with the
+        request's ID so the client can match the two up.
+        """
 
-        # get a list of names of all chats the user can access
-        elif mes.mes_purpose == MessagePurpose.GET_USER_CHAT_NAMES:
-            ip_addr = mes.sender
-            username = mes.content.value.split("\0")[0]
+        response.request_id = request.request_id
+        self.__send_message(response, encoding.decode_ip_addr(request.sender))
 
-            user_chat_names = self.__db.get_user_chat_names(username)
-            user_chat_names = json.dumps(user_chat_names)
+    def __push_message(self, mes: Message) -> None:
+        """
+        Queues a newly saved chat message to be sent to every member of the
+        chat who is online. Pushes are best effort: a member whose queue is
+        full misses the push, and their client ignores later pushes to that
+        chat until it has fetched the messages it missed.
+        """
 
-            self.__send_message(Message(
-                MessagePurpose.GET_USER_CHAT_NAMES,
-                self.ip_addr,
-                CommandData(user_chat_names),
-            ), encoding.decode_ip_addr(ip_addr))
+        members = self.__db.get_chat_data(mes.chat_name)["members"]
+        for username in members:
+            try:
+                ip_addr = self.__db.get_ip_addr_from_username(username)
+            except ValueError:
+                continue
 
-        # set the user's color scheme to a given color
-        elif mes.mes_purpose == MessagePurpose.SET_COLOR:
-            ip_addr = mes.sender
-            color = mes.content.value.split("\0")[0]
-            username = self.__db.get_username_from_ip_addr(ip_addr)
+            with self.__online_lock:
+                if ip_addr not in self.__online_ip_addrs:
+                    continue
 
-            self.__db.save_user_settings(username, color=color)
+            # keyed by recipient, so each member gets their pushes in order
+            self._push_workers.submit(ip_addr, self.__send_push, mes, ip_addr, timeout=0)
 
-        # get the user's general settings
-        elif mes.mes_purpose == MessagePurpose.GET_SETTINGS:
-            ip_addr = mes.sender
-            key = mes.content.value.split("\0")[0]
-            username = self.__db.get_username_from_ip_addr(ip_addr)
+    def __send_push(self, mes: Message, ip_addr: str) -> None:
+        """
+        Sends a pushed message to a member, marking them as offline if they
+        cannot be reached.
+        """
 
-            user_settings = self.__db.get_user_settings(username)
-            setting = user_settings[key]
+        try:
+            self.__send_message(mes, encoding.decode_ip_addr(ip_addr))
+        except OSError:
+            with self.__online_lock:
+                self.__online_ip_addrs.discard(ip_addr)
 
-            self.__send_message(Message(
-                MessagePurpose.GET_SETTINGS,
-                self.ip_addr,
-                CommandData(setting),
-            ), encoding.decode_ip_addr(ip_addr))
+    def __get_chat_data(self, chat_name: str) -> dict[str, any]:
+        chat_data = self.__db.get_chat_data(chat_name)
+        # read positions, so clients can tell who has seen which of the
+        # messages they already have
+        chat_data["reads"] = self.__db.get_chat_reads(chat_name)
 
-        # get a list of all usernames
-        elif mes.mes_purpose == MessagePurpose.GET_ALL_USERNAMES:
-            ip_addr = mes.sender
-            usernames = json.dumps(self.__db.get_all_usernames())
-            self.__send_message(Message(
-                MessagePurpose.GET_ALL_USERNAMES,
-                self.ip_addr,
-                CommandData(usernames),
-            ), encoding.decode_ip_addr(ip_addr))
+        return chat_data
 
-        # get a user's IP address given their username
-        elif mes.mes_purpose == MessagePurpose.GET_IP_ADDR:
-            ip_addr = mes.sender
-            username = mes.content.value.split("\0")[0]
-            username_ip_addr = self.__db.get_ip_addr_from_username(username)
-            self.__send_message(Message(
-                MessagePurpose.GET_IP_ADDR,
-                self.ip_addr,
-                CommandData(username_ip_addr),
-            ), encoding.decode_ip_addr(ip_addr))
+    def __get_chat_messages(self, request: dict[str, any], username: str) -> list[Message]:
+        """
+        Returns the page of messages described by a GET_CHAT_MESSAGES or
+        OPEN_CHAT request, and marks the chat as seen by the requester.
+        """
 
-        # get a chat's data
-        elif mes.mes_purpose == MessagePurpose.GET_CHAT_DATA:
-            ip_addr = mes.sender
-            chat_data = self.__db.get_chat_data(mes.content.value)
-            chat_data = json.dumps(chat_data)
+        messages = self.__db.get_chat_messages(
+            request["chatName"],
+            before=request.get("before"),
+            since=request.get("since"),
+            limit=request["numMessages"],
+        )
+        self.__db.view_messages(request["chatName"], username)
 
-            self.__send_message(Message(
-                MessagePurpose.GET_CHAT_DATA,
-                self.ip_addr,
-                CommandData(chat_data),
-            ), encoding.decode_ip_addr(ip_addr))
+        return messages
+
+    def __get_settings(
+        self,
+        username: str,
+        keys: list[str] | None,
+        version: int | None,
+    ) -> dict[str, any]:
+        """
+        Returns a user's current settings version, with the settings named
+        in `keys` (or all of them if `keys` is None) unless `version` is
+        already current.
+        """
+
+        current_version, user_settings = self.__db.get_user_settings_versioned(username)
+        if version == current_version:
+            user_settings = None
+        elif keys is not None:
+            user_settings = {key: user_settings[key] for key in keys if key in user_settings}
+
+        return {
+            "version": current_version,
+            "settings": user_settings,
+        }
+
+    def __register_handlers(self) -> None:
+        # cheap lookups answered from the database's caches run inline, bulk
+        # history reads run on their own pool so they never hold up logins or
+        # message sends, and everything else runs on the worker pool
+        self.__handlers.register(MessagePurpose.MESSAGE, self.__handle_chat_message)
+        self.__handlers.register(MessagePurpose.CREATE_USER, self.__handle_create_user)
+        self.__handlers.register(MessagePurpose.CREATE_CHAT, self.__handle_create_chat)
+        self.__handlers.register(MessagePurpose.TEST_LOGIN, self.__handle_test_login)
+        self.__handlers.register(MessagePurpose.GET_USER_CHAT_NAMES, self.__handle_get_user_chat_names)
+        self.__handlers.register(MessagePurpose.SET_COLOR, self.__handle_set_color)
+        self.__handlers.register(MessagePurpose.GET_SETTINGS, self.__handle_get_settings)
+        self.__handlers.register(MessagePurpose.GET_ALL_USERNAMES, self.__handle_get_all_usernames, Lane.INLINE)
+        self.__handlers.register(MessagePurpose.GET_IP_ADDR, self.__handle_get_ip_addr, Lane.INLINE)
+        self.__handlers.register(MessagePurpose.GET_CHAT_DATA, self.__handle_get_chat_data)
+        self.__handlers.register(MessagePurpose.GET_CHAT_MESSAGES, self.__handle_get_chat_messages, Lane.HEAVY)
+        self.__handlers.register(MessagePurpose.OPEN_CHAT, self.__handle_open_chat, Lane.HEAVY)
+        self.__handlers.register(MessagePurpose.STATS, self.__handle_stats, Lane.INLINE)
+        self.__handlers.register(MessagePurpose.SET_NICKNAME, self.__handle_set_nickname)
+        self.__handlers.register(MessagePurpose.SET_PRIVILEGE, self.__handle_set_privilege)
+        self.__handlers.register(MessagePurpose.ADD_USER_TO_CHAT, self.__handle_add_user_to_chat)
+        self.__handlers.register(MessagePurpose.REMOVE_USER_FROM_CHAT, self.__handle_remove_user_from_chat)
+
+    def __handle_request(self, handler: Callable[[Message], None], mes: Message) -> None:
+        """
+        Handles a request, recording how long it took and whether it failed.
+        """
+
+        # anyone who sends a request is listening for responses
+        with self.__online_lock:
+            self.__online_ip_addrs.add(mes.sender)
+
+        purpose = mes.mes_purpose.name
+        start = time.perf_counter()
+        try:
+            handler(mes)
+        except Exception:
+            REQUEST_ERRORS.inc(purpose)
+            raise
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, purpose)
+            REQUESTS.inc(purpose)
+
+    def __handle_chat_message(self, mes: Message) -> None:
+        """
+        Saves a chat message and pushes it to the chat's members.
+        """
 
-        # get the n most recent messages from a chat
-        elif mes.mes_purpose == MessagePurpose.GET_CHAT_MESSAGES:
-            ip_addr = mes.sender
+        print(f"Received message: {mes.content.value=}, {mes.is_encrypted=}")
+        seq = self.__db.save_message(mes)
+        self.__push_message(Message(
+            MessagePurpose.MESSAGE,
+            self.__db.get_username_from_ip_addr(mes.sender),
+            mes.content,
+            chat_name=mes.chat_name,
+            is_encrypted=mes.is_encrypted,
+            timestamp=mes.timestamp,
+            seq=seq,
+        ))
+
+    def __handle_create_user(self, mes: Message) -> None:
+        ip_addr = mes.sender
+        username = mes.content.value[:USERNAME_MAX_LEN].split("\0")[0]
+        password_hash = mes.content.value[database.USERNAME_MAX_LEN:database.USERNAME_MAX_LEN + 64]
+
+        result = self.__db.create_new_user(username, ip_addr, password_hash)
+        self.__reply(mes, Message(
+            CREATE_USER_RESPONSES[result],
+            self.ip_addr,
+            Data(),
+        ))
+
+    def __handle_create_chat(self, mes: Message) -> None:
+        data = json.loads(mes.content.value)
+        data["chat_type"] = ChatType(data["chat_type"])
+        self.__db.create_new_chat(*data.values())
+
+    def __handle_test_login(self, mes: Message) -> None:
+        """
+        Checks if the user successfully logged in.
+        """
+
+        username = mes.content.value[:USERNAME_MAX_LEN].split("\0")[0]
+        password_hash = mes.content.value[database.USERNAME_MAX_LEN:database.USERNAME_MAX_LEN + 64]
+
+        success = self.__db.test_username_password_hash_match(username, password_hash)
+        self.__reply(mes, Message(
+            MessagePurpose.TEST_LOGIN_SUCCESS if success else MessagePurpose.TEST_LOGIN_FAILURE,
+            self.ip_addr,
+            Data(),
+        ))
+
+    def __handle_get_user_chat_names(self, mes: Message) -> None:
+        """
+        Gets a list of names of all chats the user can access.
+        """
+
+        username = mes.content.value.split("\0")[0]
+
+        user_chat_names = self.__db.get_user_chat_names(username)
+        user_chat_names = json.dumps(user_chat_names)
+
+        self.__reply(mes, Message(
+            MessagePurpose.GET_USER_CHAT_NAMES,
+            self.ip_addr,
+            CommandData(user_chat_names),
+        ))
+
+    def __handle_set_color(self, mes: Message) -> None:
+        """
+        Sets the user's color scheme to a given color.
+        """
+
+        color = mes.content.value.split("\0")[0]
+        username = self.__db.get_username_from_ip_addr(mes.sender)
+
+        self.__db.save_user_settings(username, color=color)
+
+    def __handle_get_settings(self, mes: Message) -> None:
+        """
+        Gets the user's general settings.
+        """
+
+        username = self.__db.get_username_from_ip_addr(mes.sender)
+
+        # a JSON request asks for several keys (or all of them if "keys"
+        # is null) and gets nothing back if its version is still current;
+        # otherwise the request is a single key and gets its bare value
+        if mes.content.value.startswith("{"):
             request = json.loads(mes.content.value)
-            messages = self.__db.get_chat_messages(
-                request["chatName"],
-                request["numMessages"],
-            )
-            messages = [bytes(message).decode("utf-8") for message in messages]
-            messages = json.dumps(messages)
+            response = json.dumps(self.__get_settings(
+                username,
+                request.get("keys"),
+                request.get("version"),
+            ))
+        else:
+            key = mes.content.value.split("\0")[0]
+            response = self.__db.get_user_settings(username)[key]
+
+        self.__reply(mes, Message(
+            MessagePurpose.GET_SETTINGS,
+            self.ip_addr,
+            CommandData(response),
+        ))
+
+    def __handle_get_all_usernames(self, mes: Message) -> None:
+        usernames = json.dumps(self.__db.get_all_usernames())
+        self.__reply(mes, Message(
+            MessagePurpose.GET_ALL_USERNAMES,
+            self.ip_addr,
+            CommandData(usernames),
+        ))
+
+    def __handle_get_ip_addr(self, mes: Message) -> None:
+        """
+        Gets a user's IP address given their username.
+        """
 
-            self.__db.view_messages(
-                request["chatName"],
-                self.__db.get_username_from_ip_addr(ip_addr),
-            )
+        username = mes.content.value.split("\0")[0]
+        username_ip_addr = self.__db.get_ip_addr_from_username(username)
+        self.__reply(mes, Message(
+            MessagePurpose.GET_IP_ADDR,
+            self.ip_addr,
+            CommandData(username_ip_addr),
+        ))
 
-            self.__send_message(Message(
-                MessagePurpose.GET_CHAT_MESSAGES,
-                self.ip_addr,
-                CommandData(messages),
-            ), encoding.decode_ip_addr(ip_addr))
+    def __handle_get_chat_data(self, mes: Message) -> None:
+        chat_data = json.dumps(self.__get_chat_data(mes.content.value))
 
-        # set a user's nickname in a chat
-        elif mes.mes_purpose == MessagePurpose.SET_NICKNAME:
-            data = json.loads(mes.content.value)
-            self.__db.set_nickname(
-                data["chatName"],
-                data["username"],
-                data["nickname"],
-            )
+        self.__reply(mes, Message(
+            MessagePurpose.GET_CHAT_DATA,
+            self.ip_addr,
+            CommandData(chat_data),
+        ))
 
-        # set a user's privilege level in a chat
-        elif mes.mes_purpose == MessagePurpose.SET_PRIVILEGE:
-            data = json.loads(mes.content.value)
-            self.__db.set_privilege(
-                data["chatName"],
-                data["username"],
-                data["level"],
-            )
+    def __handle_get_chat_messages(self, mes: Message) -> None:
+        """
+        Gets the n most recent messages from a chat.
+        """
 
-        # add a user to a chat
-        elif mes.mes_purpose == MessagePurpose.ADD_USER_TO_CHAT:
-            data = json.loads(mes.content.value)
-            self.__db.add_user_to_chat(
-                data["chatName"],
-                data["username"],
-            )
+        request = json.loads(mes.content.value)
+        messages = self.__get_chat_messages(
+            request,
+            self.__db.get_username_from_ip_addr(mes.sender),
+        )
 
-        # remove a user from a chat
-        elif mes.mes_purpose == MessagePurpose.REMOVE_USER_FROM_CHAT:
-            data = json.loads(mes.content.value)
-            self.__db.remove_user_from_chat(
-                data["chatName"],
-                data["username"],
-            )
+        self.__reply(mes, Message(
+            MessagePurpose.GET_CHAT_MESSAGES,
+            self.ip_addr,
+            Data(Message.list_to_bytes(messages)),
+        ))
 
-            ip_addr = self.__db.get_ip_addr_from_username(data["username"])
-            self.__send_message(Message(
-                MessagePurpose.REMOVE_USER_FROM_CHAT,
-                self.ip_addr,
-                CommandData(data["chatName"]),
-            ), encoding.decode_ip_addr(ip_addr))
+    def __handle_open_chat(self, mes: Message) -> None:
+        """
+        Gets everything needed to show a chat: its data, the latest page of
+        messages and the user's settings.
+        """
+
+        request = json.loads(mes.content.value)
+        username = self.__db.get_username_from_ip_addr(mes.sender)
+
+        messages = self.__get_chat_messages(request, username)
+        metadata = json.dumps({
+            "chatData": self.__get_chat_data(request["chatName"]),
+            "settings": self.__get_settings(
+                username,
+                request.get("settingsKeys"),
+                request.get("settingsVersion"),
+            ),
+        })
+
+        # the messages are already binary, so they travel beside the JSON
+        # rather than inside it
+        self.__reply(mes, Message(
+            MessagePurpose.OPEN_CHAT,
+            self.ip_addr,
+            Data(pack_fields([
+                metadata.encode("utf-8"),
+                Message.list_to_bytes(messages),
+            ])),
+        ))
+
+    def __handle_stats(self, mes: Message) -> None:
+        self.__reply(mes, Message(
+            MessagePurpose.STATS,
+            self.ip_addr,
+            CommandData(json.dumps(metrics.REGISTRY.snapshot())),
+        ))
+
+    def __handle_set_nickname(self, mes: Message) -> None:
+        data = json.loads(mes.content.value)
+        self.__db.set_nickname(
+            data["chatName"],
+            data["username"],
+            data["nickname"],
+        )
+
+    def __handle_set_privilege(self, mes: Message) -> None:
+        data = json.loads(mes.content.value)
+        self.__db.set_privilege(
+            data["chatName"],
+            data["username"],
+            data["level"],
+        )
+
+    def __handle_add_user_to_chat(self, mes: Message) -> None:
+        data = json.loads(mes.content.value)
+        self.__db.add_user_to_chat(
+            data["chatName"],
+            data["username"],
+        )
+
+    def __handle_remove_user_from_chat(self, mes: Message) -> None:
+        data = json.loads(mes.content.value)
+        self.__db.remove_user_from_chat(
+            data["chatName"],
+            data["username"],
+        )
+
+        ip_addr = self.__db.get_ip_addr_from_username(data["username"])
+        self.__send_message(Message(
+            MessagePurpose.REMOVE_USER_FROM_CHAT,
+            self.ip_addr,
+            CommandData(data["chatName"]),
+        ), encoding.decode_ip_addr(ip_addr))
+
+    def __finish_in_flight(self, sender: str) -> None:
+        with self.__in_flight_lock:
+            self.__in_flight[sender] -= 1
+            if not self.__in_flight[sender]:
+                del self.__in_flight[sender]
+
+    def __run_in_order(self, handler: Callable[[Message], None], lane: Lane, mes: Message) -> None:
+        """
+        Runs on the sender's worker once all their earlier requests have been
+        handled, and either handles `mes` or hands it to the heavy pool. The
+        hand-off never waits, so a full heavy queue drops the request rather
+        than holding up the worker.
+        """
+
+        try:
+            if lane != Lane.HEAVY:
+                self.__handle_request(handler, mes)
+            elif not self._heavy_workers.submit(
+                mes.sender,
+                self.__handle_request,
+                handler,
+                mes,
+                timeout=0,
+            ):
+                DROPPED_REQUESTS.inc(mes.mes_purpose.name)
+                print(f"Dropped {mes.mes_purpose} from {mes.sender}: heavy queue is full.")
+        finally:
+            self.__finish_in_flight(mes.sender)
+
+    def _dispatch(self, mes: Message, timeout: float | None = SERVER_QUEUE_TIMEOUT) -> bool:
+        """
+        Runs or queues the handler of `mes` on its lane. No request starts
+        before the same sender's earlier requests have been handled: inline
+        requests only run inline when the sender has none waiting, and heavy
+        requests pass through the sender's worker on their way to the heavy
+        pool. A heavy request may still finish after later requests.
+
+        :returns: True if the message was handled or queued, False if it was
+        dropped because it has no handler or the worker's queue was full
+        """
+
+        entry = self.__handlers.get(mes.mes_purpose)
+        if entry is None:
+            print(f"Ignored {mes.mes_purpose} from {mes.sender}: no handler.")
+            return False
+
+        handler, lane = entry
+        with self.__in_flight_lock:
+            inline = lane == Lane.INLINE and mes.sender not in self.__in_flight
+            if not inline:
+                self.__in_flight[mes.sender] = self.__in_flight.get(mes.sender, 0) + 1
+
+        if inline:
+            try:
+                self.__handle_request(handler, mes)
+            except Exception:
+                traceback.print_exc()
+            return True
+
+        if self._workers.submit(mes.sender, self.__run_in_order, handler, lane, mes, timeout=timeout):
+            return True
+
+        self.__finish_in_flight(mes.sender)
+        DROPPED_REQUESTS.inc(mes.mes_purpose.name)
+        print(f"Dropped {mes.mes_purpose} from {mes.sender}: request queue is full.")
+        return False
 
     def run(self) -> None:
         self.is_running = True
-        threading.Thread(
-            target=self._listen_loop,
-            args=(self.__handle_message,),
-        ).start()
+        self._workers.start()
+        self._heavy_workers.start()
+        self._push_workers.start()
+        self._start_listening(self._dispatch)
+
+        if self.__metrics_port is not None:
+            try:
+                self.__metrics_exporter = metrics.MetricsExporter(("127.0.0.1", self.__metrics_port))
+            except OSError as e:
+                print(f"Could not serve metrics on port {self.__metrics_port}: {e}")
+            else:
+                self.__metrics_exporter.start()
+
+    def stop(self) -> None:
+        """
+        Stops accepting requests, finishes the ones already queued and closes
+        the database.
+        """
+
+        super().stop()
+        self._workers.stop()
+        self._heavy_workers.stop()
+        self._push_workers.stop()
+        self.__db.close()
+        if self.__metrics_exporter is not None:
+            self.__metrics_exporter.stop()
+            self.__metrics_exporter = None
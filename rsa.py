@@ -1,7 +1,19 @@
-import random
+import os
+import secrets
 import math_funcs
 
+from concurrent.futures import ProcessPoolExecutor
 from message import Message, Data
+from constants import RSA_KEY_BITS
+
+
+# histories with at least this many ciphertext blocks are decrypted on a
+# process pool; below it the cost of handing work to other processes dominates
+PARALLEL_DECRYPT_THRESHOLD = 2000
+
+PUBLIC_EXPONENT = 65537
+
+_executor = None
 
 
 def gen_keys(p: int, q: int) -> tuple[tuple[int, int], tuple[int, int]]:
@@ -12,8 +24,13 @@ def gen_keys(p: int, q: int) -> tuple[tuple[int, int], tuple[int, int]]:
 
     n = p * q
     totient = math_funcs.lcm(p-1, q-1)
-    e_choices = [i for i in range(1, totient) if math_funcs.is_coprime(i, totient)]
-    e = random.choice(e_choices)
+
+    # the usual public exponent, unless the primes are too small for it
+    e = PUBLIC_EXPONENT
+    if e >= totient or not math_funcs.is_coprime(e, totient):
+        e = secrets.randbelow(totient - 3) + 3
+        while not math_funcs.is_coprime(e, totient):
+            e = secrets.randbelow(totient - 3) + 3
     d = math_funcs.mod_mul_inv(e, totient)
 
     pub_key = (n, e)
@@ -21,37 +38,139 @@ def gen_keys(p: int, q: int) -> tuple[tuple[int, int], tuple[int, int]]:
 
     return (pub_key, priv_key)
 
-def encrypt(mes: Message, pub_key: tuple[int, int]) -> Message:
+def gen_keys_of_size(bits: int = RSA_KEY_BITS) -> tuple[tuple[int, int], tuple[int, int]]:
     """
-    Returns `mes` encrypted with `pub_key`.
+    Returns a public and private key with a modulus of `bits` bits, from two
+    freshly generated primes.
     """
 
-    n, e = pub_key
-    plaintext = [ord(m) for m in mes.content]
-    ciphertext = [pow(m, e, n) for m in plaintext]
+    p = math_funcs.gen_prime(bits // 2)
+    q = math_funcs.gen_prime(bits - bits // 2)
+    while q == p:
+        q = math_funcs.gen_prime(bits - bits // 2)
 
+    return gen_keys(p, q)
+
+def block_size(n: int) -> int:
+    """
+    Returns the number of plaintext bytes packed into each block for a
+    modulus `n`, the most that always gives a block smaller than `n`.
+    """
+
+    return max(1, (n.bit_length() - 1) // 8)
+
+def _with_content(mes: Message, content: Data, is_encrypted: bool) -> Message:
     return Message(
         mes.mes_purpose,
         mes.sender,
-        type(mes.content)(ciphertext),
+        content,
+        sender_username=mes.sender_username,
         chat_name=mes.chat_name,
         views=mes.views,
-        is_encrypted=True,
+        is_encrypted=is_encrypted,
+        timestamp=mes.timestamp,
+        seq=mes.seq,
+        request_id=mes.request_id,
     )
 
-def decrypt(mes: Message, priv_key: tuple[int, int]) -> Message:
+def encrypt_blocks(plaintext: str, pub_key: tuple[int, int]) -> list[int]:
     """
-    Returns `mes` decrypted with `pub_key`.
+    Returns `plaintext` encrypted with `pub_key`, packing as many bytes of its
+    UTF-8 encoding into each block as the modulus allows.
+    """
+
+    n, e = pub_key
+    size = block_size(n)
+
+    # pad with 0x80 then zeros up to a whole number of blocks
+    data = plaintext.encode("utf-8") + b"\x80"
+    data += bytes(-len(data) % size)
+
+    return [
+        pow(int.from_bytes(data[i:i+size], "big"), e, n)
+        for i in range(0, len(data), size)
+    ]
+
+def decrypt_blocks(ciphertext: list[int], priv_key: tuple[int, int]) -> str:
+    """
+    Returns the plaintext of blocks made by `encrypt_blocks`.
     """
 
     n, d = priv_key
-    ciphertext = [ord(m) for m in mes.content]
-    plaintext = [pow(m, d, n) for m in ciphertext]
+    size = block_size(n)
 
-    return Message(
-        mes.mes_purpose,
-        mes.sender,
-        type(mes.content)(plaintext),
-        chat_name=mes.chat_name,
-        views=mes.views,
-    )
+    data = b"".join(pow(c, d, n).to_bytes(size, "big") for c in ciphertext)
+    data = data.rstrip(b"\0")
+    if not data.endswith(b"\x80"):
+        raise ValueError("Ciphertext has invalid padding.")
+
+    return data[:-1].decode("utf-8")
+
+def _decrypt_value(value: str | list[int], priv_key: tuple[int, int]) -> str:
+    if isinstance(value, list):
+        return decrypt_blocks(value, priv_key)
+
+    # one block per character, as written by older clients; only their small
+    # keys keep every block below 0x110000, the largest character
+    n, d = priv_key
+    return "".join(chr(pow(ord(c), d, n)) for c in value)
+
+def encrypt(mes: Message, pub_key: tuple[int, int]) -> Message:
+    """
+    Returns `mes` encrypted with `pub_key`. The content becomes a list of
+    blocks, each holding several characters.
+    """
+
+    ciphertext = encrypt_blocks(mes.content.value, pub_key)
+
+    return _with_content(mes, type(mes.content)(ciphertext), True)
+
+def decrypt(mes: Message, priv_key: tuple[int, int]) -> Message:
+    """
+    Returns `mes` decrypted with `priv_key`. Also works with the
+    one-block-per-character strings of older clients.
+    """
+
+    plaintext = _decrypt_value(mes.content.value, priv_key)
+
+    return _with_content(mes, type(mes.content)(plaintext), False)
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor()
+
+    return _executor
+
+def decrypt_many(
+    messages: list[Message],
+    priv_key: tuple[int, int],
+    *,
+    parallel_threshold: int = PARALLEL_DECRYPT_THRESHOLD,
+) -> list[Message]:
+    """
+    Returns every message in `messages` decrypted with `priv_key`. Long
+    histories are split across a process pool.
+
+    :param parallel_threshold: the number of ciphertext blocks at which to
+    start using the process pool
+    """
+
+    values = [mes.content.value for mes in messages]
+    num_blocks = sum(len(value) for value in values)
+
+    if num_blocks < parallel_threshold or len(messages) < 2:
+        plaintexts = [_decrypt_value(value, priv_key) for value in values]
+    else:
+        chunksize = max(1, len(values) // (4 * (os.cpu_count() or 1)))
+        plaintexts = list(_get_executor().map(
+            _decrypt_value,
+            values,
+            [priv_key] * len(values),
+            chunksize=chunksize,
+        ))
+
+    return [
+        _with_content(mes, type(mes.content)(plaintext), False)
+        for mes, plaintext in zip(messages, plaintexts)
+    ]
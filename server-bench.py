@@ -0,0 +1,394 @@
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import contextlib
+import encoding
+import rsa
+
+from node import Client, Server
+from async_node import AsyncClient, AsyncServer
+from message import Message, MessagePurpose, Data, TextData, CommandData
+from chat_type import ChatType
+from constants import USERNAME_MAX_LEN
+
+
+# Starts a server and a number of simulated clients on loopback, drives a mix
+# of requests at them and reports the latency of each kind as JSON, e.g.
+#     python server-bench.py --clients 16 --rate 400 --duration 20 -o run.json
+# Each client listens on its own loopback address, so the server can tell them
+# apart. Every client waits for one request before sending the next, so use
+# more clients rather than a higher rate to put more load in flight.
+
+BENCH_SERVER_IP_ADDR = "127.0.0.1"
+BENCH_CHAT_NAME = "bench"
+BENCH_PASSWORD = "bench"
+# small keys, so the clients' own encryption does not dominate the results
+BENCH_KEY_BITS = 512
+# the most clients that can be given their own address in 127.0.0.0/24
+MAX_CLIENTS = 252
+
+# how often each kind of request is sent, relative to the others
+DEFAULT_MIX = {
+    "CREATE_USER": 1,
+    "TEST_LOGIN": 2,
+    "MESSAGE": 5,
+    "GET_CHAT_MESSAGES": 3,
+    "GET_CHAT_DATA": 2,
+}
+PERCENTILES = (50, 95, 99)
+
+# seconds to wait after the run for the last messages to be pushed back
+PUSH_GRACE_PERIOD = 2.0
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    """
+    Returns the `p`th percentile of a sorted list, by the nearest-rank method.
+    """
+
+    if not sorted_values:
+        return 0.0
+
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+class LatencyRecorder:
+    """
+    Collects the latency and outcome of every request, by purpose.
+    """
+
+    def __init__(self) -> None:
+        self.__latencies: dict[str, list[float]] = {}
+        self.__errors: dict[str, int] = {}
+        self.__lock = threading.Lock()
+
+    def record(self, purpose: str, seconds: float) -> None:
+        with self.__lock:
+            self.__latencies.setdefault(purpose, []).append(seconds)
+
+    def record_error(self, purpose: str, num_errors: int = 1) -> None:
+        with self.__lock:
+            self.__errors[purpose] = self.__errors.get(purpose, 0) + num_errors
+
+    def summary(self, duration: float) -> dict[str, dict[str, any]]:
+        """
+        :param duration: the length of the run in seconds
+        :returns: the count, errors, throughput and latency percentiles in
+        milliseconds of each purpose
+        """
+
+        with self.__lock:
+            purposes = sorted(set(self.__latencies) | set(self.__errors))
+            summary = {}
+            for purpose in purposes:
+                latencies = sorted(self.__latencies.get(purpose, []))
+                latency_ms = {
+                    f"p{p}": round(percentile(latencies, p) * 1000, 3)
+                    for p in PERCENTILES
+                }
+                latency_ms["mean"] = round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0
+                latency_ms["max"] = round(latencies[-1] * 1000, 3) if latencies else 0.0
+
+                summary[purpose] = {
+                    "count": len(latencies),
+                    "errors": self.__errors.get(purpose, 0),
+                    "throughput": round(len(latencies) / duration, 3),
+                    "latency_ms": latency_ms,
+                }
+
+        return summary
+
+class BenchClient:
+    """
+    A simulated user, sending requests through its own `Client`.
+    """
+
+    def __init__(
+        self,
+        index: int,
+        client: Client,
+        recorder: LatencyRecorder,
+        timeout: float,
+    ) -> None:
+        self.index = index
+        self.client = client
+        self.username = f"bench{index}"
+        self.__recorder = recorder
+        self.__timeout = timeout
+        self.__sender = encoding.encode_ip_addr(client.ip_addr)
+        self.__pub_key = None
+        self.__num_requests = 0
+
+        # send times of messages not yet pushed back, by timestamp
+        self.__unacked_messages: dict[float, float] = {}
+        self.__unacked_lock = threading.Lock()
+        self.client.on_chat_message = self.__handle_pushed_message
+
+    def __login_content(self, username: str) -> CommandData:
+        username_padded = username + "\0" * (USERNAME_MAX_LEN - len(username))
+        return CommandData(username_padded + encoding.hash_str(BENCH_PASSWORD))
+
+    def __timed_request(self, purpose: MessagePurpose, content: Data) -> None:
+        start = time.perf_counter()
+        try:
+            self.client.request(Message(purpose, self.__sender, content), timeout=self.__timeout)
+        except (TimeoutError, OSError):
+            self.__recorder.record_error(purpose.name)
+        else:
+            self.__recorder.record(purpose.name, time.perf_counter() - start)
+
+    def __handle_pushed_message(self, mes: Message) -> None:
+        if mes.sender != self.username:
+            return
+
+        with self.__unacked_lock:
+            start = self.__unacked_messages.pop(mes.timestamp, None)
+        if start is not None:
+            self.__recorder.record(MessagePurpose.MESSAGE.name, time.perf_counter() - start)
+
+    def create_account(self) -> None:
+        data = self.client.request(Message(
+            MessagePurpose.CREATE_USER,
+            self.__sender,
+            self.__login_content(self.username),
+        ), timeout=self.__timeout)
+        if not data.success:
+            raise RuntimeError(f"Could not create benchmark user {self.username}.")
+
+    def join_chat(self, pub_key: tuple[int, int]) -> None:
+        self.__pub_key = pub_key
+
+    def send_create_user(self) -> None:
+        # the address is always taken, so this exercises the lookups without
+        # growing the user table
+        self.__num_requests += 1
+        username = f"b{self.index}x{self.__num_requests}"[:USERNAME_MAX_LEN]
+        self.__timed_request(MessagePurpose.CREATE_USER, self.__login_content(username))
+
+    def send_test_login(self) -> None:
+        self.__timed_request(MessagePurpose.TEST_LOGIN, self.__login_content(self.username))
+
+    def send_message(self) -> None:
+        """
+        Sends a chat message, timed until the server pushes it back.
+        """
+
+        timestamp = time.time()
+        with self.__unacked_lock:
+            self.__unacked_messages[timestamp] = time.perf_counter()
+
+        try:
+            self.client.send_message(Message(
+                MessagePurpose.MESSAGE,
+                self.__sender,
+                TextData(f"benchmark message from {self.username}"),
+                chat_name=BENCH_CHAT_NAME,
+                timestamp=timestamp,
+            ), self.__pub_key)
+        except OSError:
+            with self.__unacked_lock:
+                del self.__unacked_messages[timestamp]
+            self.__recorder.record_error(MessagePurpose.MESSAGE.name)
+
+    def send_get_chat_messages(self) -> None:
+        self.__timed_request(MessagePurpose.GET_CHAT_MESSAGES, CommandData(json.dumps({
+            "chatName": BENCH_CHAT_NAME,
+            "numMessages": 10,
+        })))
+
+    def send_get_chat_data(self) -> None:
+        self.__timed_request(MessagePurpose.GET_CHAT_DATA, CommandData(BENCH_CHAT_NAME))
+
+    def run(self, rate: float, deadline: float, mix: dict[str, int], seed: int) -> None:
+        """
+        Sends requests at `rate` per second, picked at random by the weights
+        in `mix`, until `deadline`.
+        """
+
+        senders = {
+            "CREATE_USER": self.send_create_user,
+            "TEST_LOGIN": self.send_test_login,
+            "MESSAGE": self.send_message,
+            "GET_CHAT_MESSAGES": self.send_get_chat_messages,
+            "GET_CHAT_DATA": self.send_get_chat_data,
+        }
+        rng = random.Random(seed)
+        purposes = list(mix)
+        weights = [mix[purpose] for purpose in purposes]
+
+        interval = 1 / rate
+        # start each client at a different point in its interval
+        next_time = time.perf_counter() + rng.random() * interval
+        while next_time < deadline:
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            senders[rng.choices(purposes, weights)[0]]()
+            next_time += interval
+
+    def count_unacked_messages(self) -> int:
+        with self.__unacked_lock:
+            return len(self.__unacked_messages)
+
+def parse_mix(s: str) -> dict[str, int]:
+    """
+    Parses a request mix such as "MESSAGE=5,GET_CHAT_DATA=1".
+    """
+
+    mix = {}
+    for part in s.split(","):
+        purpose, _, weight = part.partition("=")
+        purpose = purpose.strip().upper()
+        if purpose not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"Cannot benchmark {purpose}, choose from {', '.join(DEFAULT_MIX)}.")
+        mix[purpose] = int(weight) if weight else 1
+
+    return mix
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(args: argparse.Namespace) -> dict[str, any]:
+    server_cls = AsyncServer if args.use_async else Server
+    client_cls = AsyncClient if args.use_async else Client
+    recorder = LatencyRecorder()
+
+    server = server_cls(ip_addr=BENCH_SERVER_IP_ADDR, metrics_port=None)
+    server.run()
+
+    bench_clients = []
+    try:
+        for i in range(args.clients):
+            # 127.0.0.1 is the server's
+            client = client_cls(f"127.0.0.{i + 2}", BENCH_SERVER_IP_ADDR)
+            client.run()
+            bench_clients.append(BenchClient(i, client, recorder, args.timeout))
+
+        for bench_client in bench_clients:
+            bench_client.create_account()
+
+        # the first client makes a chat with everyone in it; its next request
+        # is handled after the chat is made
+        pub_key, priv_key = rsa.gen_keys_of_size(BENCH_KEY_BITS)
+        owner = bench_clients[0]
+        owner.client.send_message(Message(
+            MessagePurpose.CREATE_CHAT,
+            encoding.encode_ip_addr(owner.client.ip_addr),
+            CommandData(json.dumps({
+                "chat_name": BENCH_CHAT_NAME,
+                "chat_type": ChatType.GROUP.value,
+                "public_key": pub_key,
+                "members": [bench_client.username for bench_client in bench_clients],
+                "admins": [owner.username],
+            })),
+        ))
+        owner.client.request(Message(
+            MessagePurpose.GET_CHAT_DATA,
+            encoding.encode_ip_addr(owner.client.ip_addr),
+            CommandData(BENCH_CHAT_NAME),
+        ), timeout=args.timeout)
+
+        # clients only send messages to chats they have a key for
+        os.makedirs("user-chats", exist_ok=True)
+        with open(f"user-chats/{BENCH_CHAT_NAME}.json", "w+") as f:
+            json.dump({"privKey": priv_key}, f)
+        for bench_client in bench_clients:
+            bench_client.join_chat(pub_key)
+
+        rate_per_client = args.rate / args.clients
+        start = time.perf_counter()
+        deadline = start + args.duration
+        threads = [
+            threading.Thread(
+                target=bench_client.run,
+                args=(rate_per_client, deadline, args.mix, args.seed + bench_client.index),
+            )
+            for bench_client in bench_clients
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - start
+
+        grace_deadline = time.perf_counter() + PUSH_GRACE_PERIOD
+        while time.perf_counter() < grace_deadline \
+        and any(bench_client.count_unacked_messages() for bench_client in bench_clients):
+            time.sleep(0.05)
+        for bench_client in bench_clients:
+            recorder.record_error(MessagePurpose.MESSAGE.name, bench_client.count_unacked_messages())
+
+    finally:
+        for bench_client in bench_clients:
+            bench_client.client.stop()
+        server.stop()
+
+    purposes = recorder.summary(duration)
+    return {
+        "commit": get_commit(),
+        "config": {
+            "clients": args.clients,
+            "rate": args.rate,
+            "duration": args.duration,
+            "mix": args.mix,
+            "transport": "async" if args.use_async else "threaded",
+            "seed": args.seed,
+        },
+        "duration": round(duration, 3),
+        "throughput": round(sum(p["count"] for p in purposes.values()) / duration, 3),
+        "purposes": purposes,
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measures the latency of a server under load.")
+    parser.add_argument("--clients", type=int, default=8, help="the number of simulated clients")
+    parser.add_argument("--rate", type=float, default=200, help="requests per second across all clients")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to send requests for")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX, help="request weights, e.g. MESSAGE=5,TEST_LOGIN=1")
+    parser.add_argument("--timeout", type=float, default=5, help="seconds to wait for each response")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--async", dest="use_async", action="store_true", help="use the asyncio transport")
+    parser.add_argument("-o", "--output", help="file to write the results to, instead of stdout")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the server's and clients' output")
+    args = parser.parse_args()
+
+    if not 1 <= args.clients <= MAX_CLIENTS:
+        parser.error(f"--clients must be between 1 and {MAX_CLIENTS}.")
+    if args.rate <= 0 or args.duration <= 0:
+        parser.error("--rate and --duration must be positive.")
+    if args.output is not None:
+        args.output = os.path.abspath(args.output)
+
+    # the server's database and the clients' keys go in a scratch directory
+    with tempfile.TemporaryDirectory(prefix="server-bench-") as work_dir:
+        os.chdir(work_dir)
+        if args.verbose:
+            results = run_benchmark(args)
+        else:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                results = run_benchmark(args)
+
+    results_json = json.dumps(results, indent=4)
+    if args.output is None:
+        print(results_json)
+    else:
+        with open(args.output, "w+") as f:
+            f.write(results_json + "\n")
+
+if __name__ == "__main__":
+    main()
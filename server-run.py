@@ -1,5 +1,9 @@
+import sys
+
 from node import Server
+from async_node import AsyncServer
 
 
-server = Server()
+# pass --async to use the asyncio transport
+server = AsyncServer() if "--async" in sys.argv[1:] else Server()
 server.run()
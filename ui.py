@@ -1,10 +1,7 @@
 import os
 import sys
 import time
-import socket
-import secrets
 import json
-import sympy
 import encoding
 import ip
 import vernam
@@ -15,7 +12,7 @@ from node import Client, Server
 from chat_type import ChatType
 from message import Message, MessagePurpose, TextData, CommandData, Data
 from constants import USERNAME_MAX_LEN, CHAT_NAME_MAX_LEN, MESSAGE_CONTENT_MAX_LEN, VALID_NAME_CHARS
-from ui_data import UIDataTopic
+from message_store import MessageStore
 
 
 @dataclass
@@ -29,14 +26,33 @@ COLORS = {
     "blue": Color.BLUE,
 }
 
+# the number of messages shown when a chat is opened
+CHAT_VIEW_SIZE = 10
+# the number of messages fetched at a time when catching up on a chat
+SYNC_PAGE_SIZE = 100
+
 class UI:
-    def __init__(self) -> None:
-        self.client = Client()
+    def __init__(self, client: Client | None = None) -> None:
+        """
+        :param client: the client to talk to the server through; a new
+        blocking `Client` is made if not given
+        """
+
+        self.client = client if client is not None else Client()
         self.client.run()
         self.settings = {
             "color": "white",
         }
         self.is_logged_in = False
+        # the version of the settings last fetched from the server
+        self.__settings_version = None
+
+        self.__message_store = MessageStore()
+        self.__priv_keys = {}
+        self.__open_chat_name = None
+        self.__open_chat_data = None
+        self.client.on_chat_message = self.__handle_pushed_message
+        self.client.on_chat_key_changed = self.__forget_chat
 
     def __print(self, message: str) -> None:
         print(COLORS[self.settings["color"]] + message + Color.RESET)
@@ -45,6 +61,9 @@ class UI:
         self.__print(message)
         time.sleep(delay)
 
+    def __print_not_responding(self) -> None:
+        self.__print_with_delay("\nThe server is not responding, please try again later.\n", 1)
+
     def __input(self, message: str) -> str:
         response = input(COLORS[self.settings["color"]] + message)
         print(Color.RESET, end="")
@@ -52,28 +71,42 @@ class UI:
         return response
 
     def __get_user_settings(self, key: str) -> any:
-        self.client.send_message(Message(
+        data = self.client.request(Message(
             MessagePurpose.GET_SETTINGS,
             encoding.encode_ip_addr(self.client.ip_addr),
             CommandData(key),
         ))
 
-        while not any(data.topic == UIDataTopic.SETTINGS for data in self.client.ui_data):
-            pass
-
-        for i in range(len(self.client.ui_data)):
-            if self.client.ui_data[i].topic == UIDataTopic.SETTINGS:
-                data = self.client.ui_data[i]
-                del self.client.ui_data[i]
-
-                return data.value
+        return data.value
 
     def __update_settings(self) -> None:
+        """
+        Fetches every setting in one request, unless none have changed since
+        they were last fetched.
+        """
+
         if not self.is_logged_in:
             return
 
-        for key in self.settings:
-            self.settings[key] = self.__get_user_settings(key)
+        data = self.client.request(Message(
+            MessagePurpose.GET_SETTINGS,
+            encoding.encode_ip_addr(self.client.ip_addr),
+            CommandData(json.dumps({
+                "keys": list(self.settings),
+                "version": self.__settings_version,
+            })),
+        ))
+        self.__apply_settings(json.loads(data.value))
+
+    def __apply_settings(self, response: dict[str, any]) -> None:
+        """
+        Applies a settings response from the server, which holds no settings
+        if they have not changed.
+        """
+
+        if response["settings"] is not None:
+            self.settings.update(response["settings"])
+        self.__settings_version = response["version"]
 
     def __create_user(self) -> tuple[bool, str]:
         """
@@ -95,21 +128,13 @@ class UI:
         password = self.__input("password: ")
         password_hash = encoding.hash_str(password)
 
-        self.client.send_message(Message(
+        data = self.client.request(Message(
             MessagePurpose.CREATE_USER,
             encoding.encode_ip_addr(self.client.ip_addr),
             CommandData(username_padded + password_hash),
         ))
-
-        while not any(data.topic == UIDataTopic.CREATE_USER for data in self.client.ui_data):
-            pass
-
-        for i in range(len(self.client.ui_data)):
-            if self.client.ui_data[i].topic == UIDataTopic.CREATE_USER:
-                data = self.client.ui_data[i]
-                del self.client.ui_data[i]
-                self.username = username
-                return data.success, "\nUsername already taken, please choose a different username. If this issue persists, you may already have an account under this IP address, and will need to log into that account.\n"
+        self.username = username
+        return data.success, "\nUsername already taken, please choose a different username. If this issue persists, you may already have an account under this IP address, and will need to log into that account.\n"
 
     def __log_in(self) -> bool:
         """
@@ -134,106 +159,174 @@ class UI:
             encoding.encode_ip_addr(self.client.ip_addr),
             CommandData(username_padded + password_hash),
         )
-        self.client.send_message(mes)
-
-        while not any(data.topic == UIDataTopic.LOG_IN for data in self.client.ui_data):
-            pass
-
-        for i in range(len(self.client.ui_data)):
-            if self.client.ui_data[i].topic == UIDataTopic.LOG_IN:
-                data = self.client.ui_data[i]
-                del self.client.ui_data[i]
-                self.username = username
-                return data.success
+        data = self.client.request(mes)
+        self.username = username
+        return data.success
 
         self.settings["color"] = self.__get_user_settings("color")
 
     def __get_chat_names(self) -> list[str]:
         username = self.username + "\0" * (USERNAME_MAX_LEN - len(self.username))
-        self.client.send_message(Message(
+        data = self.client.request(Message(
             MessagePurpose.GET_USER_CHAT_NAMES,
             encoding.encode_ip_addr(self.client.ip_addr),
             CommandData(username),
         ))
-
-        while not any(data.topic == UIDataTopic.GET_USER_CHAT_NAMES for data in self.client.ui_data):
-            pass
-
-        for i in range(len(self.client.ui_data)):
-            if self.client.ui_data[i].topic == UIDataTopic.GET_USER_CHAT_NAMES:
-                data = self.client.ui_data[i]
-                del self.client.ui_data[i]
-                return data.value
+        return data.value
 
     def __get_all_usernames(self) -> list[str]:
-        self.client.send_message(Message(
+        data = self.client.request(Message(
             MessagePurpose.GET_ALL_USERNAMES,
             encoding.encode_ip_addr(self.client.ip_addr),
             Data(),
         ))
-
-        while not any(data.topic == UIDataTopic.GET_ALL_USERNAMES for data in self.client.ui_data):
-            pass
-
-        for i in range(len(self.client.ui_data)):
-            if self.client.ui_data[i].topic == UIDataTopic.GET_ALL_USERNAMES:
-                data = self.client.ui_data[i]
-                del self.client.ui_data[i]
-                return data.value
+        return data.value
 
     def __get_chat_data(self, chat_name: str) -> dict[str, any]:
-        self.client.send_message(Message(
+        data = self.client.request(Message(
             MessagePurpose.GET_CHAT_DATA,
             encoding.encode_ip_addr(self.client.ip_addr),
             CommandData(chat_name),
         ))
+        return data.value
+
+    def __get_priv_key(self, chat_name: str) -> tuple[int, int] | None:
+        if chat_name in self.__priv_keys:
+            return self.__priv_keys[chat_name]
 
-        while not any(data.topic == UIDataTopic.GET_CHAT_DATA for data in self.client.ui_data):
-            pass
+        if not os.path.exists(f"user-chats/{chat_name}.json"):
+            return None
+
+        with open(f"user-chats/{chat_name}.json", "r") as f:
+            priv_key = json.load(f)
+        self.__priv_keys[chat_name] = tuple(priv_key["privKey"])
+
+        return self.__priv_keys[chat_name]
+
+    def __forget_chat(self, chat_name: str) -> None:
+        """
+        Drops a chat's cached private key and stored messages, after the
+        user was removed from it or was given a new key for it.
+        """
 
-        for i in range(len(self.client.ui_data)):
-            if self.client.ui_data[i].topic == UIDataTopic.GET_CHAT_DATA:
-                data = self.client.ui_data[i]
-                del self.client.ui_data[i]
-                return data.value
+        self.__priv_keys.pop(chat_name, None)
+        self.__message_store.remove_chat(chat_name)
 
     def __get_chat_messages(
         self,
         chat_name: str,
         num_messages: int,
+        before: int | None = None,
+        since: int | None = None,
     ) -> list[Message]:
         data = json.dumps({
             "chatName": chat_name,
             "numMessages": num_messages,
+            "before": before,
+            "since": since,
         })
 
-        self.client.send_message(Message(
+        data = self.client.request(Message(
             MessagePurpose.GET_CHAT_MESSAGES,
             encoding.encode_ip_addr(self.client.ip_addr),
             CommandData(data),
         ))
 
-        while not any(data.topic == UIDataTopic.GET_CHAT_MESSAGES for data in self.client.ui_data):
-            pass
+        priv_key = self.__get_priv_key(chat_name)
+        if priv_key is None:
+            return []
 
-        for i in range(len(self.client.ui_data)):
-            if self.client.ui_data[i].topic == UIDataTopic.GET_CHAT_MESSAGES:
-                data = self.client.ui_data[i]
-                del self.client.ui_data[i]
-                break
+        return rsa.decrypt_many(data.value, priv_key)
 
-        if not os.path.exists(f"user-chats/{chat_name}.json"):
-            return []
+    def __get_messages_since(self, chat_name: str, since: int) -> list[Message]:
+        """
+        Fetches every message newer than `since`, a page at a time.
+        """
 
-        with open(f"user-chats/{chat_name}.json", "r") as f:
-            priv_key = json.load(f)
-        priv_key = tuple(priv_key["privKey"])
+        messages = []
+        while True:
+            page = self.__get_chat_messages(chat_name, SYNC_PAGE_SIZE, since=since)
+            messages += page
+            if len(page) < SYNC_PAGE_SIZE:
+                return messages
 
-        messages = data.value
-        for i in range(len(messages)):
-            messages[i] = rsa.decrypt(messages[i], priv_key)
+            # not the store's last seq, which pushes may move on meanwhile
+            since = page[-1].seq
 
-        return messages
+    def __open_chat(self, chat_name: str) -> dict[str, any]:
+        """
+        Fetches a chat's data, the messages newer than any in the message
+        store and the user's settings, in one request unless there are more
+        new messages than fit in a page.
+
+        :returns: the chat data
+        """
+
+        since = self.__message_store.last_seq(chat_name) or None
+        # a chat seen before is caught up in full; otherwise only the latest
+        # page is fetched
+        num_messages = SYNC_PAGE_SIZE if since is not None else CHAT_VIEW_SIZE
+        data = self.client.request(Message(
+            MessagePurpose.OPEN_CHAT,
+            encoding.encode_ip_addr(self.client.ip_addr),
+            CommandData(json.dumps({
+                "chatName": chat_name,
+                "numMessages": num_messages,
+                "since": since,
+                "settingsKeys": list(self.settings),
+                "settingsVersion": self.__settings_version,
+            })),
+        ))
+
+        self.__apply_settings(data.value["settings"])
+        priv_key = self.__get_priv_key(chat_name)
+        if priv_key is None:
+            return data.value["chatData"]
+
+        page = data.value["messages"]
+        self.__message_store.add(chat_name, rsa.decrypt_many(page, priv_key))
+        if since is not None and len(page) == num_messages:
+            self.__message_store.add(chat_name, self.__get_messages_since(chat_name, page[-1].seq))
+
+        return data.value["chatData"]
+
+    def __handle_pushed_message(self, mes: Message) -> None:
+        """
+        Stores a new message pushed by the server, and shows it if its chat
+        is open. Only a message that directly follows the last one stored is
+        taken, since the next catch-up starts after the last one stored and
+        would never fetch any missed in between. After missed pushes, the
+        open chat fetches what it missed and any other chat is caught up when
+        it is next opened.
+        """
+
+        chat_name = mes.chat_name
+        last_seq = self.__message_store.last_seq(chat_name)
+        # a chat that has never been opened is fetched in full when it is, so
+        # storing just this message would leave a gap before it
+        if chat_name != self.__open_chat_name and not last_seq:
+            return
+
+        priv_key = self.__get_priv_key(chat_name)
+        if priv_key is None or mes.seq <= last_seq:
+            return
+
+        chat_data = self.__open_chat_data
+        is_shown = chat_name == self.__open_chat_name and chat_data is not None
+        if mes.seq == last_seq + 1:
+            messages = [rsa.decrypt(mes, priv_key)]
+        elif is_shown:
+            try:
+                messages = self.__get_messages_since(chat_name, last_seq)
+            except TimeoutError: # refreshing the chat catches up instead
+                return
+        else:
+            return
+
+        self.__message_store.add(chat_name, messages)
+        if is_shown:
+            for line in self.__format_messages(messages, chat_data, pad=False):
+                self.__print(line)
 
     def __run_general_settings(self) -> None:
         """
@@ -280,20 +373,12 @@ class UI:
         return "-".join(sorted([user_1, user_2]))
 
     def __get_ip_addr_from_username(self, username: str) -> str:
-        self.client.send_message(Message(
+        data = self.client.request(Message(
             MessagePurpose.GET_IP_ADDR,
             encoding.encode_ip_addr(self.client.ip_addr),
             CommandData(username),
         ))
-
-        while not any(data.topic == UIDataTopic.GET_IP_ADDR for data in self.client.ui_data):
-            pass
-
-        for i in range(len(self.client.ui_data)):
-            if self.client.ui_data[i].topic == UIDataTopic.GET_IP_ADDR:
-                data = self.client.ui_data[i]
-                del self.client.ui_data[i]
-                return encoding.decode_ip_addr(data.value)
+        return encoding.decode_ip_addr(data.value)
 
     def __gen_vernam_key(self, ip_addr: str) -> int:
         """
@@ -301,16 +386,10 @@ class UI:
         address.
         """
 
-        self.client.start_key_exchange(ip_addr)
-
-        while not any(data.topic == UIDataTopic.VERNAM_KEY for data in self.client.ui_data):
-            pass
+        exchange_id = self.client.start_key_exchange(ip_addr)
 
-        for i in range(len(self.client.ui_data)):
-            if self.client.ui_data[i].topic == UIDataTopic.VERNAM_KEY:
-                data = self.client.ui_data[i]
-                del self.client.ui_data[i]
-                return data.value
+        data = self.client.wait_for_response(exchange_id)
+        return data.value
 
     def __send_private_key(
         self,
@@ -327,14 +406,14 @@ class UI:
         ip_addr = self.__get_ip_addr_from_username(recipient_username)
         try:
             vernam_key = self.__gen_vernam_key(encoding.encode_ip_addr(ip_addr))
-        except socket.print_with_delay: # return False if the recipient is offline
+        except (OSError, TimeoutError): # return False if the recipient is offline
             return False
 
         json_data = json.dumps({
             "privKey": priv_key,
             "chatName": chat_name,
         })
-        encrypted_data = vernam.crypt(json_data, vernam_key)
+        encrypted_data = vernam.crypt_bytes(json_data.encode("utf-8"), vernam_key)
         try:
             self.client.send_message_to_ip(Message(
                 MessagePurpose.KEY,
@@ -344,7 +423,7 @@ class UI:
 
             return True
 
-        except socket.print_with_delay: # return False if the recipient is offline
+        except OSError: # return False if the recipient is offline
             return False
 
     def __run_create_chat(self) -> None:
@@ -372,10 +451,7 @@ class UI:
                     chat_name = self.__create_individual_chat_name(self.username, other_username)
                     chat_names = self.__get_chat_names()
                     if chat_name not in chat_names: # check if user already has this chat
-                        pub_key, priv_key = rsa.gen_keys(
-                            secrets.choice(list(sympy.primerange(100, 200))),
-                            secrets.choice(list(sympy.primerange(100, 200))),
-                        )
+                        pub_key, priv_key = rsa.gen_keys_of_size()
                         if self.__send_private_key(
                             priv_key,
                             other_username,
@@ -404,6 +480,7 @@ class UI:
                                 data = json.dump({
                                     "privKey": priv_key,
                                 }, f, indent=4)
+                            self.__forget_chat(chat_name)
 
                             self.__print_with_delay("\nCreated chat!\n")
                         else:
@@ -439,10 +516,7 @@ class UI:
                         else:
                             self.__print("\nThis user does not exist!")
 
-                    pub_key, priv_key = rsa.gen_keys(
-                        secrets.choice(list(sympy.primerange(100, 200))),
-                        secrets.choice(list(sympy.primerange(100, 200))),
-                    )
+                    pub_key, priv_key = rsa.gen_keys_of_size()
 
                     added = []
                     for username in other_usernames:
@@ -478,6 +552,7 @@ class UI:
                             data = json.dump({
                                 "privKey": priv_key,
                             }, f, indent=4)
+                        self.__forget_chat(chat_name)
 
                         self.__print_with_delay("\nCreated chat!\n")
                     else:
@@ -489,14 +564,27 @@ class UI:
         self,
         messages: list[Message],
         chat_data: dict[str, any],
+        pad: bool = True,
     ) -> list[str]:
+        """
+        :param pad: if True, the lines are cut or padded to fill the terminal
+        above the menu
+        """
+
         cols, rows = os.get_terminal_size(0)
         lines = []
         for message in messages:
             message_lines = [
                 f"[{chat_data['nicknames'][message.sender]}] {message.content.value}"
             ]
-            views = [chat_data["nicknames"][name] for name in message.views if name]
+            if "reads" in chat_data:
+                viewers = [
+                    name for name, last_read_seq in chat_data["reads"].items()
+                    if last_read_seq >= message.seq
+                ]
+            else:
+                viewers = message.views
+            views = [chat_data["nicknames"][name] for name in viewers if name]
             if views:
                 views = ", ".join(views)
                 message_lines[0] += f"\t[seen by {views}]"
@@ -506,6 +594,9 @@ class UI:
                 message_lines[0] = message_lines[0][:cols]
             lines += message_lines
 
+        if not pad:
+            return lines
+
         # leave 5 lines at bottom, also account for 2 already printed at top
         NUM_CLEAR_LINES = 10
         lines = lines[-rows:] + ["" for _ in range(rows - len(lines) - NUM_CLEAR_LINES - 2)]
@@ -693,14 +784,27 @@ class UI:
         Allows the user to interact with a chat.
         """
 
-        self.__update_settings()
-
+        # new messages are pushed by the server while the chat is open, and
+        # any already in the message store are not fetched again
+        self.__open_chat_name = chat_name
+        try:
+            chat_data = self.__open_chat(chat_name)
+            self.__open_chat_data = chat_data
+            self.__run_chat_view(chat_name, chat_data)
+        finally:
+            self.__open_chat_name = None
+            self.__open_chat_data = None
+
+    def __run_chat_view(
+        self,
+        chat_name: str,
+        chat_data: dict[str, any],
+    ) -> None:
         while True:
             os.system("clear")
             self.__print(f"{chat_name}\n")
 
-            chat_data = self.__get_chat_data(chat_name)
-            messages = self.__get_chat_messages(chat_name, 10)
+            messages = self.__message_store.get_messages(chat_name, CHAT_VIEW_SIZE)
             for line in self.__format_messages(messages, chat_data):
                 self.__print(line)
 
@@ -713,34 +817,41 @@ class UI:
             if option == "1":
                 break
 
-            if option == "2":
-                message = self.__input("Message (leave blank to cancel): ").strip()
-                if message:
-                    if len(message) <= MESSAGE_CONTENT_MAX_LEN:
-                        self.client.send_message(Message(
-                            MessagePurpose.MESSAGE,
-                            encoding.encode_ip_addr(self.client.ip_addr),
-                            TextData(message),
-                            chat_name=chat_name,
-                        ), tuple(chat_data["pubKey"]))
-                    else:
-                        self.__print_with_delay(f"\nMessage is too long, please use a maximum of {MESSAGE_CONTENT_MAX_LEN} characters.\n")
+            try:
+                if option == "2":
+                    message = self.__input("Message (leave blank to cancel): ").strip()
+                    if message:
+                        if len(message) <= MESSAGE_CONTENT_MAX_LEN:
+                            self.client.send_message(Message(
+                                MessagePurpose.MESSAGE,
+                                encoding.encode_ip_addr(self.client.ip_addr),
+                                TextData(message),
+                                chat_name=chat_name,
+                            ), tuple(chat_data["pubKey"]))
+                        else:
+                            self.__print_with_delay(f"\nMessage is too long, please use a maximum of {MESSAGE_CONTENT_MAX_LEN} characters.\n")
 
-            elif option == "3":
-                continue
+                elif option == "3":
+                    chat_data.update(self.__open_chat(chat_name))
 
-            elif option == "4":
-                self.__run_chat_settings(chat_name)
+                elif option == "4":
+                    self.__run_chat_settings(chat_name)
+                    chat_data.update(self.__get_chat_data(chat_name))
 
-            else:
-                self.__print_with_delay("\nPlease enter a valid option.\n")
+                else:
+                    self.__print_with_delay("\nPlease enter a valid option.\n")
+            except TimeoutError:
+                self.__print_not_responding()
 
     def __run_main_menu(self) -> None:
         """
         Allows the user to select a chat or edit general settings.
         """
 
-        self.__update_settings()
+        try:
+            self.__update_settings()
+        except TimeoutError:
+            self.__print_not_responding()
 
         while True:
             os.system("clear")
@@ -749,7 +860,12 @@ class UI:
             self.__print("2) edit general settings")
             self.__print("3) create new chat")
 
-            user_chats = self.__get_chat_names()
+            try:
+                user_chats = self.__get_chat_names()
+            except TimeoutError:
+                user_chats = []
+                self.__print("\n(could not fetch your chats, the server is not responding)")
+
             for i in range(len(user_chats)):
                 self.__print(f"{i+4}) view {user_chats[i]}")
 
@@ -758,17 +874,20 @@ class UI:
             if option == "1":
                 break
 
-            if option == "2":
-                self.__run_general_settings()
+            try:
+                if option == "2":
+                    self.__run_general_settings()
 
-            elif option == "3":
-                self.__run_create_chat()
+                elif option == "3":
+                    self.__run_create_chat()
 
-            elif option.isdigit() and int(option) - 4 < len(user_chats):
-                self.__run_chat(user_chats[int(option) - 4])
+                elif option.isdigit() and int(option) - 4 < len(user_chats):
+                    self.__run_chat(user_chats[int(option) - 4])
 
-            else:
-                self.__print_with_delay("\nPlease enter a valid option.\n")
+                else:
+                    self.__print_with_delay("\nPlease enter a valid option.\n")
+            except TimeoutError:
+                self.__print_not_responding()
 
     def run_login_page(self) -> None:
         """
@@ -776,7 +895,10 @@ class UI:
         existing one.
         """
 
-        self.__update_settings()
+        try:
+            self.__update_settings()
+        except TimeoutError:
+            self.__print_not_responding()
 
         while True:
             os.system("clear")
@@ -790,19 +912,22 @@ class UI:
                 self.client.is_running = False
                 break
 
-            elif option == "2":
-                success, error_message = self.__create_user()
-                if success:
-                    self.is_logged_in = True
-                    self.__print_with_delay("\nCreated user!\n")
-                    self.__run_main_menu()
-                else:
-                    self.__print_with_delay(error_message, 1)
+            try:
+                if option == "2":
+                    success, error_message = self.__create_user()
+                    if success:
+                        self.is_logged_in = True
+                        self.__print_with_delay("\nCreated user!\n")
+                        self.__run_main_menu()
+                    else:
+                        self.__print_with_delay(error_message, 1)
 
-            elif option == "3":
-                if self.__log_in():
-                    self.is_logged_in = True
-                    self.__print_with_delay("\nLogged in!\n")
-                    self.__run_main_menu()
-                else:
-                    self.__print_with_delay("\nUsername or password is wrong, please try again.\n")
+                elif option == "3":
+                    if self.__log_in():
+                        self.is_logged_in = True
+                        self.__print_with_delay("\nLogged in!\n")
+                        self.__run_main_menu()
+                    else:
+                        self.__print_with_delay("\nUsername or password is wrong, please try again.\n")
+            except TimeoutError:
+                self.__print_not_responding()
@@ -1,7 +1,14 @@
+import threading
+
 from enum import Enum
+from collections import defaultdict, deque
 from dataclasses import dataclass
 
 
+# seconds the UI waits for a response before giving up
+RESPONSE_TIMEOUT = 10.0
+
+
 class UIDataTopic(Enum):
     VERNAM_KEY          = 0
     CREATE_USER         = 1
@@ -12,9 +19,55 @@ class UIDataTopic(Enum):
     GET_IP_ADDR         = 6
     GET_CHAT_DATA       = 7
     GET_CHAT_MESSAGES   = 8
+    OPEN_CHAT           = 9
+    STATS               = 10
 
 @dataclass
 class UIData:
     topic: UIDataTopic
     success: bool
     value: any = None
+    # the ID of the request this answers, or 0 if it is not a response
+    request_id: int = 0
+
+class UIDataQueue:
+    """
+    Responses waiting to be picked up by the UI, queued by the ID of the
+    request they answer, or by topic if they do not answer a request. Waiting
+    for a key sleeps until a response with that key arrives.
+    """
+
+    def __init__(self) -> None:
+        self.__queues: dict[UIDataTopic | int, deque[UIData]] = defaultdict(deque)
+        self.__cond = threading.Condition()
+
+    def __len__(self) -> int:
+        with self.__cond:
+            return sum(len(q) for q in self.__queues.values())
+
+    def put(self, data: UIData) -> None:
+        key = data.request_id or data.topic
+        with self.__cond:
+            self.__queues[key].append(data)
+            self.__cond.notify_all()
+
+    def get(self, key: UIDataTopic | int, timeout: float | None = RESPONSE_TIMEOUT) -> UIData:
+        """
+        Removes and returns the oldest response with the given request ID or
+        topic, waiting for one to arrive if there are none.
+
+        :param timeout: the maximum number of seconds to wait, or None to
+        wait forever
+        :raises TimeoutError: if no response arrived in time
+        """
+
+        with self.__cond:
+            if not self.__cond.wait_for(lambda: self.__queues[key], timeout):
+                del self.__queues[key]
+                raise TimeoutError(f"No response to {key} within {timeout} seconds.")
+
+            data = self.__queues[key].popleft()
+            if not self.__queues[key]:
+                del self.__queues[key]
+
+            return data
@@ -9,17 +9,64 @@ def int_to_str(n: int) -> str:
 
     return "".join(n_chars)
 
+def key_to_bytes(key: int) -> bytes:
+    """
+    Returns the key stream block for `key`, the same bytes that `int_to_str`
+    gives as characters.
+    """
+
+    return int_to_str(key).encode("latin-1")
+
 def str_xor(a: str, b: str) -> str:
-    c = ""
-    for i in range(len(a)):
-        c += chr(ord(a[i]) ^ ord(b[i]))
+    return "".join(chr(ord(a[i]) ^ ord(b[i])) for i in range(len(a)))
+
+def _xor_with_key(data: bytes, key: bytes, offset: int) -> bytes:
+    """
+    Returns `data` XORed with `key` repeated, starting `offset` bytes into
+    the key. The whole buffer is XORed as two big integers.
+    """
+
+    if not data:
+        return b""
+
+    repeats = math.ceil((offset + len(data)) / len(key))
+    stream = (key * repeats)[offset:offset + len(data)]
+    result = int.from_bytes(data, "big") ^ int.from_bytes(stream, "big")
+
+    return result.to_bytes(len(data), "big")
+
+def crypt_bytes(data: bytes, key: int) -> bytes:
+    """
+    Encrypts or decrypts `data` with `key`.
+    """
+
+    return _xor_with_key(data, key_to_bytes(key), 0)
+
+class VernamStream:
+    """
+    Encrypts or decrypts a payload in chunks. Feeding a payload through
+    `update` in any number of pieces gives the same bytes as `crypt_bytes`
+    on the whole payload.
+    """
+
+    def __init__(self, key: int) -> None:
+        self.__key = key_to_bytes(key)
+        self.__offset = 0
+
+    def update(self, chunk: bytes) -> bytes:
+        result = _xor_with_key(chunk, self.__key, self.__offset)
+        self.__offset = (self.__offset + len(chunk)) % len(self.__key)
 
-    return c
+        return result
 
 def crypt(s: str, key: int) -> str:
-    key = int_to_str(key)
-    key *= math.ceil(len(s) / len(key))
+    try:
+        data = s.encode("latin-1")
+    except UnicodeEncodeError:
+        # the key only touches the low 8 bits of each character
+        key = int_to_str(key)
+        key *= math.ceil(len(s) / len(key))
 
-    result = str_xor(s, key)
+        return str_xor(s, key)
 
-    return result
+    return crypt_bytes(data, key).decode("latin-1")
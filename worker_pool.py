@@ -0,0 +1,92 @@
+import queue
+import threading
+import traceback
+
+from typing import Callable
+
+
+class WorkerPool:
+    """
+    A fixed number of worker threads, each with its own bounded queue. Tasks
+    submitted with the same key always run on the same worker, so they run
+    in the order they were submitted.
+    """
+
+    def __init__(
+        self,
+        num_workers: int,
+        max_queue_depth: int,
+        name: str = "worker",
+    ) -> None:
+        """
+        :param num_workers: the number of worker threads
+        :param max_queue_depth: the maximum number of waiting tasks per worker
+        :param name: the prefix of the worker threads' names
+        """
+
+        if num_workers < 1:
+            raise ValueError(f"WorkerPool needs at least one worker, not {num_workers}.")
+
+        self.num_workers = num_workers
+        self.max_queue_depth = max_queue_depth
+        self.name = name
+        self.__queues = [queue.Queue(max_queue_depth) for _ in range(num_workers)]
+        self.__threads = []
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(q.qsize() for q in self.__queues)
+
+    def __work(self, q: queue.Queue) -> None:
+        while True:
+            task = q.get()
+            if task is None:
+                break
+
+            func, args = task
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+
+    def start(self) -> None:
+        for i, q in enumerate(self.__queues):
+            thread = threading.Thread(
+                target=self.__work,
+                args=(q,),
+                name=f"{self.name}-{i}",
+                daemon=True,
+            )
+            thread.start()
+            self.__threads.append(thread)
+
+    def submit(
+        self,
+        key: str,
+        func: Callable,
+        *args,
+        timeout: float | None = None,
+    ) -> bool:
+        """
+        Queues `func(*args)` on the worker that owns `key`.
+
+        :param key: tasks with equal keys run in submission order
+        :param timeout: seconds to wait for room in a full queue; 0 never
+        waits and None waits forever
+        :returns: True if the task was queued, False if the queue stayed full
+        """
+
+        q = self.__queues[hash(key) % self.num_workers]
+        try:
+            q.put((func, args), block=timeout != 0, timeout=timeout or None)
+        except queue.Full:
+            return False
+
+        return True
+
+    def stop(self) -> None:
+        for q in self.__queues:
+            q.put(None)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []